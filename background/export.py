@@ -0,0 +1,274 @@
+"""Export orders for reporting, as newline-delimited JSON and/or Parquet.
+
+Orders are read a page at a time with query cursors, so memory use is bounded
+by the page size no matter how many orders there are. Each record is an
+order's `as_dict()`, without the payment token, plus its id, location and
+last update time.
+
+Usage:
+  python export.py --output DIR [--location ID] [--start DATE] [--end DATE]
+                   [--format ndjson|parquet|both] [--checkpoint FILE]
+
+Dates are ISO 8601 (e.g. 2019-04-09 or 2019-04-09T12:00:00+00:00) and filter
+on the order's `created` time; orders written before that field was added
+are only included when no dates are given. Without --location, every
+location is exported.
+
+Output is split into numbered files of --rows-per-file records. With
+--checkpoint, progress is saved each time a file is completed, and a rerun
+with the same arguments resumes from there. Parquet output needs pyarrow.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+from google.cloud import firestore
+
+from model import model
+
+
+def order_query(db, location, start=None, end=None):
+    query = model.OrdersCollection(db, location)
+    if start or end:
+        if start:
+            query = query.where('created', '>=', start)
+        if end:
+            query = query.where('created', '<', end)
+        query = query.order_by('created')
+    return query.order_by('__name__')
+
+
+def cursor_for(snapshot):
+    """Returns a JSON-friendly cursor positioned after snapshot."""
+    cursor = {'__name__': snapshot.id}
+    created = (snapshot.to_dict() or {}).get('created')
+    if created:
+        cursor['created'] = created.isoformat()
+    return cursor
+
+
+def stream_pages(query, page_size, cursor=None):
+    """Yields lists of DocumentSnapshots, one page per RPC."""
+    query = query.limit(page_size)
+    while True:
+        page_query = query
+        if cursor:
+            cursor = dict(cursor)
+            if 'created' in cursor:
+                cursor['created'] = datetime.datetime.fromisoformat(
+                    cursor['created'])
+            page_query = query.start_after(cursor)
+        page = list(page_query.stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        cursor = cursor_for(page[-1])
+
+
+def to_record(snapshot, location):
+    order = model.Order(snapshot)
+    record = order.as_dict()
+    del record['token']
+    record['id'] = order.id
+    record['location'] = location
+    record['updated'] = order.date.ToJsonString()
+    return record
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class NdjsonWriter:
+    suffix = '.ndjson'
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+
+    def write(self, records):
+        for record in records:
+            self._file.write(json.dumps(record, default=_json_default))
+            self._file.write('\n')
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Writes each page of records as a Parquet row group."""
+
+    suffix = '.parquet'
+    COLUMNS = ('id', 'location', 'user', 'done', 'totalPrice', 'created',
+               'updated', 'items', 'extra')
+
+    def __init__(self, path):
+        import pyarrow  # Optional; only needed for Parquet output.
+        from pyarrow import parquet
+        self._pyarrow = pyarrow
+        self._schema = pyarrow.schema([
+            ('id', pyarrow.string()),
+            ('location', pyarrow.string()),
+            ('user', pyarrow.string()),
+            ('done', pyarrow.bool_()),
+            ('totalPrice', pyarrow.float64()),
+            ('created', pyarrow.string()),
+            ('updated', pyarrow.string()),
+            # Items and unknown fields vary in shape, so are kept as JSON.
+            ('items', pyarrow.string()),
+            ('extra', pyarrow.string()),
+        ])
+        self._writer = parquet.ParquetWriter(path, self._schema)
+
+    def _row(self, record):
+        record = dict(record)
+        row = {
+            'id': record.pop('id'),
+            'location': record.pop('location'),
+            'user': str(record.pop('user')),
+            'done': bool(record.pop('done')),
+            'totalPrice': record.pop('totalPrice'),
+            'created': None,
+            'updated': record.pop('updated'),
+            'items': json.dumps(record.pop('items'), default=_json_default),
+        }
+        created = record.pop('created', None)
+        if created:
+            row['created'] = _json_default(created)
+        row['extra'] = json.dumps(record, default=_json_default)
+        return row
+
+    def write(self, records):
+        rows = [self._row(x) for x in records]
+        columns = {c: [row[c] for row in rows] for c in self.COLUMNS}
+        self._writer.write_table(
+            self._pyarrow.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {
+    'ndjson': [NdjsonWriter],
+    'parquet': [ParquetWriter],
+    'both': [NdjsonWriter, ParquetWriter],
+}
+
+
+class Exporter:
+    """Writes records into numbered files, checkpointing as each closes."""
+
+    def __init__(self, output, writers, rows_per_file, checkpoint):
+        self.output = output
+        self.writers = writers
+        self.rows_per_file = rows_per_file
+        self.checkpoint = checkpoint
+        self.state = {'part': 0, 'done': [], 'location': None, 'cursor': None}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                self.state = json.load(f)
+        self.rows = 0
+        self.bytes = 0
+        self._open = []
+        self._rows_in_part = 0
+        self._position = (None, None)
+
+    def write(self, records, location, cursor):
+        if not self._open:
+            base = os.path.join(self.output,
+                                'orders-%05d' % self.state['part'])
+            self._open = [(w(base + w.suffix), base + w.suffix)
+                          for w in self.writers]
+        for writer, _ in self._open:
+            writer.write(records)
+        self.rows += len(records)
+        self._rows_in_part += len(records)
+        self._position = (location, cursor)
+        if self._rows_in_part >= self.rows_per_file:
+            self.finish_part()
+
+    def finish_part(self):
+        if not self._open:
+            return
+        for writer, path in self._open:
+            writer.close()
+            self.bytes += os.path.getsize(path)
+        self._open = []
+        self._rows_in_part = 0
+        self.state['part'] += 1
+        self.state['location'], self.state['cursor'] = self._position
+        self.save()
+
+    def finish_location(self, location):
+        self.finish_part()
+        self.state['done'].append(location)
+        self.state['location'] = self.state['cursor'] = None
+        self.save()
+
+    def save(self):
+        if not self.checkpoint:
+            return
+        tmp_path = self.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.checkpoint)
+
+
+def export(db, exporter, locations, start=None, end=None, page_size=500):
+    for location in locations:
+        if location in exporter.state['done']:
+            continue
+        cursor = None
+        if exporter.state['location'] == location:
+            cursor = exporter.state['cursor']
+        query = order_query(db, location, start, end)
+        for page in stream_pages(query, page_size, cursor):
+            exporter.write([to_record(x, location) for x in page], location,
+                           cursor_for(page[-1]))
+        exporter.finish_location(location)
+
+
+def parse_date(value):
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', required=True,
+                        help='Directory to write the export to.')
+    parser.add_argument('--location', action='append',
+                        help='Location to export; repeat for several.')
+    parser.add_argument('--start', type=parse_date,
+                        help='Only orders created at or after this time.')
+    parser.add_argument('--end', type=parse_date,
+                        help='Only orders created before this time.')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    parser.add_argument('--checkpoint',
+                        help='File recording progress, for resuming.')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--rows-per-file', type=int, default=100000)
+    args = parser.parse_args()
+
+    db = firestore.Client()
+    os.makedirs(args.output, exist_ok=True)
+    exporter = Exporter(args.output, WRITERS[args.format], args.rows_per_file,
+                        args.checkpoint)
+    begin = time.perf_counter()
+    export(db, exporter, args.location or model.Locations(db), args.start,
+           args.end, args.page_size)
+    seconds = time.perf_counter() - begin
+    print('Exported %d orders (%.1f MB) in %.1fs: %.1f orders/s, %.2f MB/s' %
+          (exporter.rows, exporter.bytes / 1e6, seconds,
+           exporter.rows / max(seconds, 1e-9),
+           exporter.bytes / 1e6 / max(seconds, 1e-9)))
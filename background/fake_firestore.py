@@ -0,0 +1,626 @@
+"""An in-memory stand-in for the Firestore client, for local simulation.
+
+`Client` implements the parts of the google-cloud-firestore API which this
+project uses: document and collection references, queries with filters,
+ordering, limits and cursors, batches, transactions (as driven by
+`firestore.transactional`) and `write_option(last_update_time=...)`
+preconditions. Refs are `firestore.DocumentReference` instances, so the
+model's helpers accept them as they do real ones.
+
+It also does what the real service does around each call:
+  * each RPC sleeps for `latency` seconds (a number, or a function returning
+    one), using the `sleep` function given, so that callers see realistic
+    delays, real or simulated;
+  * `stats` counts RPCs, documents read and documents written, and `tally`
+    counts those made by one thread;
+  * every committed write is passed, as a Cloud Functions event, to the
+    listeners registered with `on_write` whose path pattern it matches.
+
+Time comes from the `clock` function given, so that a simulation can run
+on virtual time. Documents' update times are strictly increasing, as
+preconditions rely on.
+
+Only local tools (simulate.py and test_model.py here, loadtest.py in voice)
+use it, so .gcloudignore leaves it out of deployments.
+"""
+
+import collections
+import contextlib
+import copy
+import datetime
+import fnmatch
+import itertools
+import threading
+import time
+import types
+import uuid
+
+from google.api_core import exceptions
+from google.cloud import firestore
+from google.protobuf import timestamp_pb2
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _timestamp(seconds):
+    ts = timestamp_pb2.Timestamp()
+    ts.FromNanoseconds(int(round(seconds * 1e9)))
+    return ts
+
+
+def _datetime(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+
+
+def exponential(rng, mean):
+    """Returns a random duration with the given mean, or 0 if it's 0; e.g.
+    for a `latency` function."""
+    return rng.expovariate(1 / mean) if mean > 0 else 0
+
+
+def encode_value(value):
+    """Encodes a value as in a Firestore event payload."""
+    if value is None:
+        return {'nullValue': None}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'integerValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, datetime.datetime):
+        return {'timestampValue': value.astimezone(
+            datetime.timezone.utc).isoformat().replace('+00:00', 'Z')}
+    if isinstance(value, DocumentReference):
+        return {'referenceValue': value.path}
+    if isinstance(value, dict):
+        return {'mapValue': {'fields': encode_fields(value)}}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [encode_value(x) for x in value]}}
+    return {'stringValue': str(value)}
+
+
+def encode_fields(data: dict):
+    return {k: encode_value(v) for k, v in data.items()}
+
+
+def _matches(pattern, path):
+    parts = pattern.split('/')
+    return len(parts) == len(path) and all(
+        fnmatch.fnmatchcase(x, p) for x, p in zip(path, parts))
+
+
+def _get_field(data, field_path):
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(field_path)
+        data = data[part]
+    return data
+
+
+def _set_field(data, field_path, value):
+    *parents, last = field_path.split('.')
+    for part in parents:
+        data = data.setdefault(part, {})
+    if value is firestore.DELETE_FIELD:
+        data.pop(last, None)
+    else:
+        data[last] = value
+
+
+def _resolve(data, now):
+    """Replaces SERVER_TIMESTAMP sentinels with the time of the write."""
+    if data is firestore.SERVER_TIMESTAMP:
+        return _datetime(now)
+    if isinstance(data, dict):
+        return {k: _resolve(v, now) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_resolve(x, now) for x in data]
+    return data
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None,
+                 read_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = read_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        return copy.deepcopy(_get_field(self._data, field_path))
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return copy.deepcopy(self._data)
+
+
+class DocumentReference(firestore.DocumentReference):
+    def __init__(self, *path, client=None):
+        self._path = tuple(path)
+        self._client = client
+
+    def __eq__(self, other):
+        if isinstance(other, DocumentReference):
+            return self._client is other._client and self._path == other._path
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def __repr__(self):
+        return '<DocumentReference %s>' % self.path
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    @property
+    def path(self):
+        return '/'.join(self._path)
+
+    @property
+    def parent(self):
+        return CollectionReference(*self._path[:-1], client=self._client)
+
+    def collection(self, collection_id):
+        return CollectionReference(*self._path, collection_id,
+                                   client=self._client)
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._rpc()
+        snapshot = self._client._snapshot(self._path, field_paths)
+        if transaction is not None:
+            transaction._read(snapshot)
+        return snapshot
+
+    def create(self, document_data):
+        return self._client._commit([('create', self, document_data, None)])[0]
+
+    def set(self, document_data, merge=False):
+        return self._client._commit(
+            [('set', self, document_data, merge)])[0]
+
+    def update(self, field_updates, option=None):
+        return self._client._commit(
+            [('update', self, field_updates, option)])[0]
+
+    def delete(self, option=None):
+        return self._client._commit([('delete', self, None, option)])[0]
+
+
+class Query:
+    def __init__(self, parent, filters=(), orders=(), limit=None,
+                 start_after=None, projection=None):
+        self._parent = parent
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **changes):
+        fields = {
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'start_after': self._start_after,
+            'projection': self._projection,
+        }
+        fields.update(changes)
+        return Query(self._parent, **fields)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + (
+            (field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_after(self, document_fields):
+        return self._copy(start_after=document_fields)
+
+    def _sort_key(self, path, data):
+        key = []
+        for field, direction in self._orders + (('__name__', None),):
+            if field == '__name__':
+                value = path
+            else:
+                value = _get_field(data, field)
+            key.append(value)
+        return tuple(key)
+
+    def _cursor_key(self):
+        cursor = self._start_after
+        if isinstance(cursor, DocumentSnapshot):
+            data = cursor.to_dict() or {}
+            names = {'__name__': cursor.reference}
+        else:
+            data = cursor
+            names = cursor
+        key = []
+        for field, _ in self._orders + (('__name__', None),):
+            if field != '__name__':
+                key.append(_get_field(data, field))
+                continue
+            name = names.get('__name__')
+            if name is None:
+                break
+            if isinstance(name, str):
+                name = self._parent.document(name)
+            key.append(name._path)
+        return tuple(key)
+
+    def stream(self, transaction=None):
+        client = self._parent._client
+        client._rpc()
+        matches = []
+        with client._lock:
+            for path, data in client._documents_in(self._parent._path):
+                try:
+                    if not all(_OPERATORS[op](_get_field(data, field), value)
+                               for field, op, value in self._filters):
+                        continue
+                    key = self._sort_key(path, data)
+                except (KeyError, TypeError):
+                    continue
+                matches.append((key, path))
+        matches.sort(key=lambda x: x[1])
+        for position, (field, direction) in reversed(
+                list(enumerate(self._orders))):
+            matches.sort(key=lambda x: x[0][position],
+                         reverse=direction == 'DESCENDING')
+        if self._start_after is not None:
+            after = self._cursor_key()
+            matches = [(key, path) for key, path in matches
+                       if self._after(key[:len(after)], after)]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+        for _, path in matches:
+            snapshot = client._snapshot(path, self._projection)
+            if transaction is not None:
+                transaction._read(snapshot)
+            yield snapshot
+
+    def _after(self, key, cursor):
+        for position, (value, bound) in enumerate(zip(key, cursor)):
+            if value == bound:
+                continue
+            descending = (position < len(self._orders) and
+                          self._orders[position][1] == 'DESCENDING')
+            return (value < bound) if descending else (value > bound)
+        return False
+
+    def get(self, transaction=None):
+        return self.stream(transaction)
+
+
+class CollectionReference(Query):
+    def __init__(self, *path, client=None):
+        self._path = tuple(path)
+        self._client = client
+        super().__init__(self)
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    @property
+    def parent(self):
+        if len(self._path) == 1:
+            return None
+        return DocumentReference(*self._path[:-1], client=self._client)
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return DocumentReference(*self._path, document_id,
+                                 client=self._client)
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        result = ref.create(document_data)
+        return result.update_time, ref
+
+    def list_documents(self, page_size=None):
+        """Returns refs to every document in the collection, including
+        missing ones which only have subcollections, as Firestore does."""
+        self._client._rpc()
+        depth = len(self._path)
+        with self._client._lock:
+            ids = {path[depth] for path in self._client._store
+                   if len(path) > depth and path[:depth] == self._path}
+        return (self.document(x) for x in sorted(ids))
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+
+class Transaction(WriteBatch):
+    """Implements the hooks `firestore.transactional` drives.
+
+    Transactions are optimistic: commit fails with Aborted, and the
+    transactional function is retried, if any document read in the
+    transaction has changed since it was read.
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._reads = {}
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _read(self, snapshot):
+        self._reads.setdefault(snapshot.reference._path, snapshot.update_time)
+
+    def _commit(self):
+        writes, reads = self._writes, self._reads
+        results = self._client._commit(writes, reads)
+        self._clean_up()
+        return results
+
+    def commit(self):
+        return self._commit()
+
+
+class Client:
+    def __init__(self, clock=time.time, sleep=time.sleep, latency=0):
+        self._clock = clock
+        self._sleep = sleep
+        self.latency = latency
+        self._lock = threading.RLock()
+        # path tuple -> (data, create_time, update_time)
+        self._store = {}
+        self._last_time = 0
+        self._listeners = []
+        self._event_ids = itertools.count(1)
+        self._local = threading.local()
+        self.stats = collections.Counter()
+
+    def collection(self, *path):
+        if len(path) == 1:
+            path = path[0].split('/')
+        return CollectionReference(*path, client=self)
+
+    def document(self, *path):
+        if len(path) == 1:
+            path = path[0].split('/')
+        return DocumentReference(*path, client=self)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return Transaction(self, max_attempts, read_only)
+
+    @staticmethod
+    def write_option(**kwargs):
+        return kwargs
+
+    def on_write(self, pattern, listener):
+        """Calls listener(data, context) after each write to a document whose
+        path matches pattern, e.g. 'locations/*/orders/*'."""
+        self._listeners.append((pattern, listener))
+
+    @contextlib.contextmanager
+    def tally(self):
+        """Yields a Counter of the RPCs, reads and writes made by this thread
+        in the body."""
+        counts = collections.Counter()
+        outer = getattr(self._local, 'tallies', ())
+        self._local.tallies = outer + (counts,)
+        try:
+            yield counts
+        finally:
+            self._local.tallies = outer
+
+    def _count(self, name, value=1):
+        self.stats[name] += value
+        for counts in getattr(self._local, 'tallies', ()):
+            counts[name] += value
+
+    def _rpc(self):
+        self._count('rpcs')
+        latency = self.latency
+        if callable(latency):
+            latency = latency()
+        if latency:
+            self._sleep(latency)
+
+    def _now(self):
+        """Returns the time for a write, later than any before it."""
+        now = max(self._clock(), self._last_time + 1e-6)
+        self._last_time = now
+        return now
+
+    def _documents_in(self, collection_path):
+        depth = len(collection_path) + 1
+        for path, (data, _, _) in list(self._store.items()):
+            if len(path) == depth and path[:-1] == collection_path:
+                yield path, data
+
+    def _snapshot(self, path, field_paths=None):
+        with self._lock:
+            data, created, updated = self._store.get(path, (None, None, None))
+            data = copy.deepcopy(data)
+        self._count('reads')
+        if data is not None and field_paths is not None:
+            projected = {}
+            for field in field_paths:
+                try:
+                    _set_field(projected, field, _get_field(data, field))
+                except KeyError:
+                    pass
+            data = projected
+        return DocumentSnapshot(
+            DocumentReference(*path, client=self), data,
+            created and _timestamp(created), updated and _timestamp(updated),
+            _timestamp(self._clock()))
+
+    def _commit(self, writes, reads=None):
+        """Applies writes atomically, returning a WriteResult for each.
+
+        Raises Aborted if a document in reads (path -> update time it was
+        read at) has changed since.
+        """
+        self._rpc()
+        events = []
+        with self._lock:
+            for path, read_at in (reads or {}).items():
+                current = self._store.get(path, (None, None, None))[2]
+                if (current and _timestamp(current)) != read_at:
+                    raise exceptions.Aborted('Transaction contention on %s'
+                                             % '/'.join(path))
+            now = self._now()
+            pending = {}
+            for kind, ref, data, option in writes:
+                path = ref._path
+                old = pending.get(path, self._store.get(path))
+                new = self._apply(kind, path, old, data, option, now)
+                pending[path] = new
+                events.append((path, old, new))
+            for path, new in pending.items():
+                if new is None:
+                    self._store.pop(path, None)
+                else:
+                    self._store[path] = new
+            self._count('writes', len(writes))
+        for path, old, new in events:
+            self._notify(path, old, new, now)
+        return [WriteResult(_timestamp(now)) for _ in writes]
+
+    def _apply(self, kind, path, old, data, option, now):
+        name = '/'.join(path)
+        if kind == 'delete':
+            return None
+        if kind == 'create' and old is not None:
+            raise exceptions.Conflict('Document already exists: %s' % name)
+        if kind == 'update':
+            if old is None:
+                raise exceptions.NotFound('No document to update: %s' % name)
+            last_update_time = (option or {}).get('last_update_time')
+            if (last_update_time is not None and
+                    last_update_time != _timestamp(old[2])):
+                raise exceptions.FailedPrecondition(
+                    'Document %s has been updated since %s' %
+                    (name, last_update_time.ToJsonString()))
+            document = copy.deepcopy(old[0])
+            for field, value in data.items():
+                _set_field(document, field, _resolve(value, now))
+        else:
+            document = {}
+            # For a set, option is the merge flag.
+            if kind == 'set' and option and old is not None:
+                document = copy.deepcopy(old[0])
+            _merge(document, _resolve(data, now))
+        created = old[1] if old is not None else now
+        return (document, created, now)
+
+    def _notify(self, path, old, new, now):
+        name = '/'.join(path)
+        listeners = [fn for pattern, fn in self._listeners
+                     if _matches(pattern, path)]
+        if not listeners:
+            return
+        data = {
+            'oldValue': self._event_value(name, old),
+            'value': self._event_value(name, new),
+        }
+        context = types.SimpleNamespace(
+            event_id=str(next(self._event_ids)),
+            timestamp=_datetime(now).isoformat().replace('+00:00', 'Z'),
+            event_type='providers/cloud.firestore/eventTypes/document.write',
+            resource='projects/local/databases/(default)/documents/' + name)
+        for listener in listeners:
+            listener(data, context)
+
+    @staticmethod
+    def _event_value(name, document):
+        if document is None:
+            return {}
+        data, created, updated = document
+        return {
+            'name': name,
+            'fields': encode_fields(data),
+            'createTime': _timestamp(created).ToJsonString(),
+            'updateTime': _timestamp(updated).ToJsonString(),
+        }
@@ -1,39 +1,126 @@
-"""Function to perform background processing of Firestore updates.
+"""Functions to perform background processing of Firestore updates.
 
 To deploy, try something like:
 
 $ gcloud functions deploy background --runtime python37 \
     --trigger-event providers/cloud.firestore.eventTypes/document.write \
-    --trigger-resource projects/$PROJECT_ID/databases/(default)/documents/orders/{order}
+    --trigger-resource projects/$PROJECT_ID/databases/(default)/documents/locations/{location}/orders/{order}
+
+`menu_snapshot` needs deploying twice, once for dishes and once for their
+ingredients:
+
+$ gcloud functions deploy menu_snapshot --runtime python37 \
+    --trigger-event providers/cloud.firestore.eventTypes/document.write \
+    --trigger-resource projects/$PROJECT_ID/databases/(default)/documents/locations/{location}/dishes/{dish}
+$ gcloud functions deploy menu_snapshot_ingredients --entry-point menu_snapshot \
+    --runtime python37 \
+    --trigger-event providers/cloud.firestore.eventTypes/document.write \
+    --trigger-resource projects/$PROJECT_ID/databases/(default)/documents/locations/{location}/dishes/{dish}/ingredients/{ingredient}
 """
 
 import logging
 import time
 from google.cloud import firestore
 
+import rollups
+from model import metrics
 from model import model
+from model import tracing
+
+# How many times menu_snapshot writes a menu before giving up on one which
+# keeps changing.
+MAX_SNAPSHOT_WRITES = 5
 
 db = firestore.Client()
+metrics.instrument_firestore(db)
+tracing.instrument_firestore(db)
+
+
+def _document_path(context):
+    """Returns the path of the document which triggered an event."""
+    url = context.resource
+    return url[url.find('/documents/') + len('/documents/'):]
 
 
 def background(data, context):
     """Reconcile changes to a Firestore order object."""
-    url = context.resource
-    path = url[url.find('/documents/') + len('/documents/'):]
-    logging.info('Loading %s (%s)', url, path)
+    # Join the trace of the conversation which wrote the order.
+    fields = data.get('value', {}).get('fields', {})
+    trace_id = fields.get(tracing.TRACE_FIELD, {}).get('stringValue')
+    with tracing.span('background', trace_id, event=context.event_id):
+        _reconcile(data, context)
+
+
+def _reconcile(data, context):
+    path = _document_path(context)
+    try:
+        _reconcile_order(path, context)
+    finally:
+        _record_rollups(path, data, context)
+
+
+def _record_rollups(path, data, context):
+    """Counts the write in its location's sales rollups.
+
+    Failures are only logged: the order matters more than its stats, which
+    `python rollups.py` can rebuild.
+    """
+    # locations/{location}/orders/{order}
+    try:
+        rollups.record_event(db, path.split('/')[1], data, context)
+    except Exception:
+        logging.exception('Failed to count event %s in rollups',
+                          context.event_id)
+
+
+def _reconcile_order(path, context):
+    logging.info('Loading %s (%s)', context.resource, path)
     doc = db.document(path).get()
     if not doc.exists:
         logging.info('Ignoring deleted document %s', path)
         return
     order = model.Order(doc)
+    # The `background` span; reconcile runs inside Order.set's.
+    span = tracing.current()
 
-    if not order.total:
-        order.updateTotal(model.PriceSheet(model.AllDishes(db)))
-
+    # The payment being processed, if any.
+    token = None
     if not order.done and order.token:
+        token = order.token
         time.sleep(40)
-        order.done = True
 
-    if order.as_dict() != doc.to_dict():
-        logging.info('Updating %s', order.ref.path)
-        order.set()
+    marked_done = False
+
+    def reconcile(order):
+        nonlocal marked_done
+        marked_done = False
+        if not order.total:
+            order.updateTotal(model.CachedMenu(db, order.location).prices)
+        if not order.done and token and order.token == token:
+            order.done = True
+            marked_done = True
+
+    # Only writes the fields changed by reconcile, if any. If the order has
+    # changed meanwhile, reconcile is re-run on the new version.
+    if order.set(reconcile) and marked_done:
+        span.attributes['done'] = True
+
+
+def menu_snapshot(data, context):
+    """Recompile a location's menu document after a change to its dishes.
+
+    Invocations for edits made close together overlap, and one which read
+    older dishes may write after one which read newer. So after writing,
+    the dishes are read again and the menu rewritten if it's out of date,
+    until it isn't: whichever invocation writes last leaves the current menu.
+    """
+    # locations/{location}/dishes/{dish}[/ingredients/{ingredient}]
+    location = _document_path(context).split('/')[1]
+    for _ in range(MAX_SNAPSHOT_WRITES):
+        menu = model.Menu(model.AllDishes(db, location))
+        if model.MenuVersion(db, location) == menu.version:
+            logging.info('Menu for %s is at %s', location, menu.version)
+            return
+        logging.info('Writing menu version %s for %s', menu.version, location)
+        model.MenuRef(db, location).set(menu.as_dict())
+    logging.warning('Menu for %s kept changing while compiling it', location)
@@ -0,0 +1,96 @@
+"""Move pre-location menu and order data under a location.
+
+Before orders were partitioned by kitchen, they lived in the top-level
+`orders` collection and the menu in `dishes` (with an `ingredients`
+subcollection per dish). This copies them, keeping document ids, to
+`locations/{location}/orders` and `locations/{location}/dishes`.
+
+Usage:
+  python migrate_locations.py [--location ID] [--dry-run] [--delete]
+
+Copies are written in batches of up to 500. With --delete, the original
+documents are removed once their copies have been committed. Note that each
+copied order fires the `background` trigger for its new path, as if it had
+just been written.
+"""
+
+import argparse
+import logging
+import sys
+from google.cloud import firestore
+
+from model import model
+
+MAX_BATCH_SIZE = 500
+
+
+class Migration:
+    """Copies documents in batches, optionally deleting the originals."""
+
+    def __init__(self, db, dry_run=False, delete=False):
+        self.db = db
+        self.dry_run = dry_run
+        self.delete = delete
+        self.copied = 0
+        self._pending = []
+
+    def copy(self, snapshot, destination):
+        self._pending.append((snapshot, destination))
+        if len(self._pending) * (2 if self.delete else 1) >= MAX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        if not self.dry_run:
+            batch = self.db.batch()
+            for snapshot, destination in self._pending:
+                batch.set(destination, snapshot.to_dict())
+                if self.delete:
+                    batch.delete(snapshot.reference)
+            batch.commit()
+        self.copied += len(self._pending)
+        print('%s %d documents' % ('Would copy' if self.dry_run else 'Copied',
+                                   self.copied))
+        self._pending = []
+
+
+def migrate(db, location, dry_run=False, delete=False):
+    target = model.LocationRef(db, location)
+    migration = Migration(db, dry_run, delete)
+    if not dry_run:
+        target.set({'name': location}, merge=True)
+
+    for dish in db.collection('dishes').stream():
+        new_dish = target.collection('dishes').document(dish.id)
+        # Copy ingredients first, so that the dish is never deleted while it
+        # still has children to migrate.
+        for ingredient in dish.reference.collection('ingredients').stream():
+            migration.copy(
+                ingredient,
+                new_dish.collection('ingredients').document(ingredient.id))
+        migration.copy(dish, new_dish)
+
+    for order in db.collection('orders').stream():
+        migration.copy(order, model.OrdersCollection(
+            db, location).document(order.id))
+
+    migration.flush()
+    return migration.copied
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--location', default=model.DEFAULT_LOCATION,
+                        help='The location to move existing data to.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Count documents without writing anything.')
+    parser.add_argument('--delete', action='store_true',
+                        help='Delete the originals after copying them.')
+    args = parser.parse_args()
+
+    copied = migrate(firestore.Client(), args.location, args.dry_run,
+                     args.delete)
+    print('Migrated %d documents to location %s' % (copied, args.location))
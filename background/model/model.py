@@ -7,12 +7,33 @@ DocumentSnapshot. If a DocumentReference is provided, the data object will
 call .get() to fetch a copy. Generally, this will be as efficient as feeding
 the object from .get() into the model, except in cases where you want to reuse
 the dictionary.
+
+Each kitchen is a location with its own menu and orders, stored under
+`locations/{location}/dishes` and `locations/{location}/orders`. The
+`background` function also compiles each location's dishes into a single
+`locations/{location}/config/menu` document, so that the whole menu can be
+loaded with one read. voice/make_entities.py also writes it into each bundle
+as `model/menus/{location}.json`, which is loaded when the model is imported.
 """
 
+import copy
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 
+from google.api_core import exceptions
 from google.cloud import firestore
 
+from model import metrics
+from model import singleflight
+from model import tracing
+
+# The location used when none is given, e.g. LOCATION=downtown.
+DEFAULT_LOCATION = os.getenv('LOCATION', 'default')
+
 
 def _materialize_ref_if_needed(ref_or_snapshot):
     """Return a DocumentSnapshot, given a ref or a snapshot."""
@@ -28,13 +49,34 @@ class Dish:
         self.name = data.id
         self.price = data.get('price')
         self._ref = data.reference
+        self._ingredients = None
 
     @property
     def ingredients(self):
-        """Yields a list of Ingredient objects for this dish."""
-        ingredients = self._ref.collection('ingredients')
-        for item in ingredients.stream():
-            yield Ingredient(item)
+        """A list of Ingredient objects for this dish, read on first use."""
+        if self._ingredients is None:
+            ingredients = self._ref.collection('ingredients')
+            self._ingredients = [Ingredient(x) for x in ingredients.stream()]
+        return self._ingredients
+
+    @classmethod
+    def from_dict(cls, name, data):
+        """Builds a Dish from its entry in a compiled menu."""
+        dish = cls.__new__(cls)
+        dish.name = name
+        dish.price = data.get('price')
+        dish._ref = None
+        dish._ingredients = [
+            Ingredient.from_dict(k, v)
+            for k, v in sorted(data.get('ingredients', {}).items())
+        ]
+        return dish
+
+    def as_dict(self):
+        return {
+            'price': self.price,
+            'ingredients': {x.name: x.as_dict() for x in self.ingredients},
+        }
 
 
 class Ingredient:
@@ -47,6 +89,23 @@ class Ingredient:
         self.choices = data.get('names')
         self.price = data.get('charge', 0)
 
+    @classmethod
+    def from_dict(cls, name, data):
+        """Builds an Ingredient from its entry in a compiled menu."""
+        ingredient = cls.__new__(cls)
+        ingredient.name = name
+        ingredient.max_items = data.get('max', 0)
+        ingredient.choices = data.get('names')
+        ingredient.price = data.get('charge', 0)
+        return ingredient
+
+    def as_dict(self):
+        return {
+            'max': self.max_items,
+            'names': self.choices,
+            'charge': self.price,
+        }
+
 
 class OrderItem:
     def __init__(self, item=None, **kwds):
@@ -72,25 +131,48 @@ class OrderItem:
         return value
 
 
+# How many times Order.set tries to write before giving up on conflicts.
+MAX_SET_ATTEMPTS = 3
+
+# The order field holding the time it was last written, for delta syncs.
+UPDATED_FIELD = 'updated'
+
+# The value of each order field which the document lacks.
+ORDER_DEFAULTS = {
+    'user': '0',
+    'done': False,
+    'items': [],
+    'token': {},
+    'totalPrice': None,
+}
+
+
 class Order:
     def __init__(self, ref_or_snapshot):
         data = _materialize_ref_if_needed(ref_or_snapshot)
 
         self.id = data.reference.id
         self.__ref = data.reference
-        self.date = data.update_time
-        self.items = []
-        raw = data.to_dict() or {}
-        logging.info('Data from %s is %s', self.__ref, raw)
+        self._read(data)
+        logging.info('Data from %s is %s', self.__ref, self._saved)
         logging.info('Path is %s (%s)', '/'.join(self.__ref._path),
                      type(self.__ref))
         logging.info('Reading path: %s', self.__ref.path)
-        self.user = raw.pop('user', '0')
-        self.done = raw.pop('done', False)
-        self.token = raw.pop('token', {})
-        self.total = raw.pop('totalPrice', None)
-        for item in raw.pop('items', []):
-            self.items.append(OrderItem(**item))
+
+    def _read(self, snapshot):
+        """Loads the order's fields from snapshot, as last saved."""
+        self.date = snapshot.update_time
+        raw = snapshot.to_dict() or {}
+        self._saved = copy.deepcopy(raw)
+        self._assign(raw)
+
+    def _assign(self, raw: dict):
+        raw = dict(copy.deepcopy(ORDER_DEFAULTS), **raw)
+        self.user = raw.pop('user')
+        self.done = raw.pop('done')
+        self.token = raw.pop('token')
+        self.total = raw.pop('totalPrice')
+        self.items = [OrderItem(**item) for item in raw.pop('items')]
         self.extra_fields = raw
 
     @property
@@ -101,6 +183,17 @@ class Order:
     def path(self):
         return self.__ref.path
 
+    @property
+    def trace_id(self):
+        """The id of the trace this order's processing is recorded in."""
+        return self.extra_fields.get(tracing.TRACE_FIELD)
+
+    @property
+    def location(self):
+        """The id of the location this order was placed at."""
+        location = self.__ref.parent.parent
+        return location.id if location else DEFAULT_LOCATION
+
     def updateTotal(self, price_map: dict):
         total = 0
         for item in self.items:
@@ -111,6 +204,7 @@ class Order:
     def for_json(self):
         return {
             'id': self.id,
+            'location': self.location,
             'items': self.items,
             'user': self.user,
             'done': self.done,
@@ -130,14 +224,82 @@ class Order:
         base.update(self.extra_fields)
         return base
 
-    def set(self):
-        data = self.as_dict()
-        logging.info('Writing %s', data)
-        self.__ref.set(data)
-
-
-def AllDishes(db):
-    return (Dish(x) for x in db.collection('dishes').get())
+    def changes(self):
+        """Returns {field: value} for each field changed since the order was
+        read or last saved, with DELETE_FIELD for removed fields.
+
+        Fields the document lacks aren't included while they keep their
+        default value, so they can't overwrite a value written since.
+        """
+        current = self.as_dict()
+        changed = {}
+        for field, value in current.items():
+            if field in self._saved:
+                if self._saved[field] != value:
+                    changed[field] = value
+            elif field not in ORDER_DEFAULTS or value != ORDER_DEFAULTS[field]:
+                changed[field] = value
+        for field in self._saved:
+            if field not in current:
+                changed[field] = firestore.DELETE_FIELD
+        return changed
+
+    @tracing.traced('Order.set')
+    def set(self, update=None, attempts=MAX_SET_ATTEMPTS):
+        """Writes the fields changed since the order was read.
+
+        If given, update(order) is called first to make the changes. The
+        write only succeeds if the order is unchanged since it was read. If
+        it has changed, the order is re-read and update is called again on
+        the fresh copy, up to attempts times in all. Without update, the
+        changes can't be recomputed, so the conflict is raised.
+
+        Raises:
+          FailedPrecondition if the order kept changing.
+
+        Returns whether anything was written.
+        """
+        for attempt in range(1, attempts + 1):
+            if update is not None:
+                update(self)
+            changes = self.changes()
+            if not changes:
+                logging.info('No changes to %s', self.path)
+                return False
+            logging.info('Updating %s with %s', self.path, changes)
+            option = self.__ref._client.write_option(
+                last_update_time=self.date)
+            try:
+                written = dict(changes)
+                written[UPDATED_FIELD] = firestore.SERVER_TIMESTAMP
+                result = self.__ref.update(written, option=option)
+            except exceptions.FailedPrecondition:
+                if update is None or attempt == attempts:
+                    raise
+                logging.info('%s changed since read, retrying', self.path)
+                self._read(self.__ref.get())
+                continue
+            self.date = result.update_time
+            self._saved = copy.deepcopy(self.as_dict())
+            return True
+
+
+def LocationRef(db, location=DEFAULT_LOCATION):
+    return db.collection('locations').document(location)
+
+
+def Locations(db):
+    """Returns the ids of all locations."""
+    return [x.id for x in db.collection('locations').list_documents()]
+
+
+def OrdersCollection(db, location=DEFAULT_LOCATION):
+    return LocationRef(db, location).collection('orders')
+
+
+def AllDishes(db, location=DEFAULT_LOCATION):
+    return (Dish(x)
+            for x in LocationRef(db, location).collection('dishes').get())
 
 
 def PriceSheet(dishes):
@@ -151,11 +313,217 @@ def PriceSheet(dishes):
     return price_sheet
 
 
-def OpenOrders(db):
-    return (Order(x)
-            for x in db.collection('orders').where('done', '==', False).get())
+# How long an instance may reuse its copy of the menu before re-reading it.
+MENU_MAX_AGE = 300
+
+_menu_cache = {}
+
+# Concurrent reads of the same menu, or its version, share one RPC.
+_menu_reads = singleflight.Group('menu')
+
+# Locations whose cached menu came from a bundled snapshot, and hasn't yet
+# been checked against Firestore.
+_unchecked_snapshots = set()
+
+# Where make_entities.py writes compiled menus for bundling, one per location.
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), 'menus')
+
+
+class Menu:
+    """A per-instance copy of a location's dishes and price sheet."""
+
+    def __init__(self, dishes, version=None):
+        self.dishes = list(dishes)
+        self.prices = PriceSheet(self.dishes)
+        self.loaded = time.monotonic()
+        self.version = version or self._content_version()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a Menu from the compiled form written by as_dict."""
+        dishes = (Dish.from_dict(k, v)
+                  for k, v in sorted(data.get('dishes', {}).items()))
+        return cls(dishes, data.get('version'))
+
+    def as_dict(self):
+        return {
+            'version': self.version,
+            'dishes': {x.name: x.as_dict() for x in self.dishes},
+        }
 
+    def _content_version(self):
+        """A hash of the menu's contents, which changes whenever they do."""
+        content = sorted(
+            (dish.name, dish.price,
+             sorted((x.name, x.max_items, x.price, sorted(x.choices or []))
+                    for x in dish.ingredients))
+            for dish in self.dishes)
+        return hashlib.sha1(repr(content).encode('utf-8')).hexdigest()[:16]
+
+
+def MenuRef(db, location=DEFAULT_LOCATION):
+    """Returns the reference of location's compiled menu document."""
+    return LocationRef(db, location).collection('config').document('menu')
+
+
+@tracing.traced('LoadMenu')
+def LoadMenu(db, location=DEFAULT_LOCATION):
+    """Reads location's Menu from its compiled document in a single fetch.
+
+    Falls back to reading every dish if the menu hasn't been compiled yet.
+    """
+    snapshot = MenuRef(db, location).get()
+    if snapshot.exists:
+        return Menu.from_dict(snapshot.to_dict())
+    return Menu(AllDishes(db, location))
+
+
+def MenuVersion(db, location=DEFAULT_LOCATION):
+    """Reads only the version field of location's compiled menu."""
+    snapshot = MenuRef(db, location).get(field_paths=['version'])
+    return (snapshot.to_dict() or {}).get('version')
+
+
+@tracing.traced('CachedMenu')
+def CachedMenu(db, location=DEFAULT_LOCATION, max_age=MENU_MAX_AGE):
+    """Returns location's Menu, re-reading it only if our copy is stale.
+
+    Once our copy is older than max_age, the menu is only reloaded if the
+    compiled version differs from ours. A copy loaded from a bundled snapshot
+    is also checked, in another thread, the first time it's used.
+    """
+    if location in _unchecked_snapshots:
+        try:
+            _unchecked_snapshots.remove(location)
+        except KeyError:
+            pass  # Another thread got there first.
+        else:
+            threading.Thread(target=_check_snapshot, args=(db, location),
+                             daemon=True).start()
+    menu = _menu_cache.get(location)
+    hit = menu is not None and time.monotonic() - menu.loaded <= max_age
+    if menu is not None and not hit:
+        version = _menu_reads.do(('version', location), MenuVersion, db,
+                                 location)
+        hit = version == menu.version
+        if hit:
+            menu.loaded = time.monotonic()
+    metrics.cache_lookup('menu', hit)
+    if not hit:
+        menu = _menu_reads.do(('menu', location), LoadMenu, db, location)
+        _menu_cache[location] = menu
+    return menu
+
+
+def _check_snapshot(db, location):
+    """Replaces location's bundled menu if the one in Firestore differs."""
+    menu = _menu_cache[location]
+    try:
+        if MenuVersion(db, location) == menu.version:
+            menu.loaded = time.monotonic()
+            return
+        logging.info('Menu snapshot for %s is out of date', location)
+        _menu_cache[location] = LoadMenu(db, location)
+    except Exception:
+        logging.exception('Failed to check menu snapshot for %s', location)
+
+
+def SnapshotMenu(location=DEFAULT_LOCATION, directory=SNAPSHOT_DIR):
+    """Reads location's Menu from its bundled snapshot, or returns None."""
+    try:
+        with open(os.path.join(directory, location + '.json')) as f:
+            return Menu.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def WriteSnapshot(menu, location=DEFAULT_LOCATION, directory=SNAPSHOT_DIR):
+    """Writes menu as location's snapshot, as compact JSON."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, location + '.json'), 'w') as f:
+        json.dump(menu.as_dict(), f, separators=(',', ':'), sort_keys=True)
+
+
+def _load_snapshots():
+    """Seeds the menu cache from the bundled snapshots, without any RPCs.
+
+    Each location's snapshot is checked against Firestore, in the
+    background, the first time CachedMenu is called for it.
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return
+    for name in sorted(os.listdir(SNAPSHOT_DIR)):
+        location, extension = os.path.splitext(name)
+        if extension == '.json':
+            _menu_cache[location] = SnapshotMenu(location, SNAPSHOT_DIR)
+            _unchecked_snapshots.add(location)
+
+
+_load_snapshots()
+
+
+def OpenOrders(db, location=DEFAULT_LOCATION):
+    query = OrdersCollection(db, location).where('done', '==', False)
+    return (Order(x) for x in query.get())
+
+
+def UserOrders(db, user, location=DEFAULT_LOCATION, since=None):
+    """Returns user's orders, or only those written after since if given.
+
+    Filtering on since needs a composite index on (user, updated).
+    """
+    query = OrdersCollection(db, location).where('user', '==', user)
+    if since:
+        query = query.where(UPDATED_FIELD, '>', since)
+    return (Order(x) for x in query.get())
+
+
+# Rollups are split over this many shard documents, so that a busy period
+# doesn't overload a single document with writes.
+ROLLUP_SHARDS = 10
+
+
+def RollupRef(db, location, period):
+    """Returns the document holding location's sales rollup for period.
+
+    period is either a UTC day (2019-04-09) or hour (2019-04-09T13). The
+    counts themselves are in the document's `shards` subcollection.
+    """
+    return LocationRef(db, location).collection('stats').document(period)
+
+
+def add_counts(total: dict, delta: dict, sign=1):
+    """Adds (or with sign=-1, subtracts) nested counts in delta to total."""
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            add_counts(total.setdefault(key, {}), value, sign)
+        else:
+            total[key] = total.get(key, 0) + sign * value
+    return total
+
+
+def Rollup(db, location, period):
+    """Reads location's sales for period, summing its shards."""
+    total = {}
+    for shard in RollupRef(db, location, period).collection('shards').stream():
+        add_counts(total, shard.to_dict())
+    return total
+
+
+def OrderPages(query, page_size=500, start_after=None):
+    """Yields lists of Orders matching query, one page per RPC.
 
-def UserOrders(db, user):
-    return (Order(x)
-            for x in db.collection('orders').where('user', '==', user).get())
+    Pages are ordered by document id so that only one page needs to be held
+    in memory. Pass the id of the last Order seen as `start_after` to resume.
+    """
+    query = query.order_by('__name__').limit(page_size)
+    while True:
+        page_query = query
+        if start_after:
+            page_query = query.start_after({'__name__': start_after})
+        page = [Order(x) for x in page_query.stream()]
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        start_after = page[-1].id
@@ -0,0 +1,150 @@
+"""Lightweight tracing spans across the web app, voice webhook and background.
+
+A span times one operation: a request or intent handler, a model method or a
+Firestore RPC. Spans opened while another is current become its children, and
+share its trace id. An order's trace id is stored on the order document in
+the TRACE_FIELD field, so that each turn of the conversation and each
+`background` invocation for the order joins the same trace.
+
+Finished spans are handed to the exporter set with `set_exporter`. Setting
+TRACE_FILE in the environment installs a FileExporter writing to that path;
+otherwise spans are discarded.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+from model import metrics
+
+# The order document field holding the order's trace id.
+TRACE_FIELD = 'traceId'
+
+_local = threading.local()
+_exporter = [None]
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+class Span:
+    def __init__(self, name, trace_id, parent=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()[:16]
+        self.parent = parent
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentId': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'durationMs': (self.end - self.start) * 1000,
+            'attributes': self.attributes,
+        }
+
+
+class FileExporter:
+    """Appends each span to a file as a line of JSON."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+
+def set_exporter(exporter):
+    """Sets the object whose export(span) receives finished spans."""
+    _exporter[0] = exporter
+
+
+def current():
+    """Returns the current Span, or None."""
+    return getattr(_local, 'span', None)
+
+
+def current_trace_id():
+    span = current()
+    return span.trace_id if span else None
+
+
+def start_span(name, trace_id=None, **attributes):
+    """Starts a span and makes it current.
+
+    The span is a child of the current one, if any. Otherwise it joins
+    trace_id, or starts a new trace.
+    """
+    parent = current()
+    if parent:
+        span = Span(name, parent.trace_id, parent, **attributes)
+    else:
+        span = Span(name, trace_id or new_id(), **attributes)
+    _local.span = span
+    return span
+
+
+def finish_span(span):
+    span.end = time.time()
+    _local.span = span.parent
+    if _exporter[0]:
+        _exporter[0].export(span)
+
+
+@contextlib.contextmanager
+def span(name, trace_id=None, **attributes):
+    """Runs the body in a span, recording any exception raised."""
+    s = start_span(name, trace_id, **attributes)
+    try:
+        yield s
+    except Exception as e:
+        s.attributes['error'] = repr(e)
+        raise
+    finally:
+        finish_span(s)
+
+
+def traced(name):
+    """Decorates a function to run in a span called name."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_firestore(db):
+    """Wraps every RPC made by the Firestore client db in a span.
+
+    Streaming RPCs (queries and batch gets) are timed until the call
+    returns, not until the results have been consumed.
+    """
+    api = getattr(db, '_firestore_api', None)
+    if api is None:
+        return
+    for method in metrics.FIRESTORE_METHODS:
+        if hasattr(api, method):
+            setattr(api, method,
+                    traced('firestore.' + method)(getattr(api, method)))
+
+
+if os.getenv('TRACE_FILE'):
+    set_exporter(FileExporter(os.getenv('TRACE_FILE')))
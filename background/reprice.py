@@ -0,0 +1,176 @@
+"""Reprice open orders after a change to menu prices.
+
+`background` only fills in `totalPrice` when an order doesn't have one yet, so
+open orders priced before a dish `price` or ingredient `charge` changed keep
+their stale totals. This walks the open orders page by page, prices them all
+against one freshly-loaded price sheet, and writes back only the totals which
+changed, in WriteBatches of up to 500 committed across a pool of workers.
+Each total is only written if the order is unchanged since it was read, so
+that a total the voice agent has written since isn't overwritten; orders
+which have changed are re-read and repriced one by one.
+
+Usage:
+  python reprice.py [--location ID] [--dry-run] [--checkpoint FILE]
+                    [--page-size N] [--workers N]
+
+Note: you must have already configured your Google Cloud credentials. If a
+checkpoint file is given, the id of the last fully-committed order is saved
+there after each page, and a later run with the same file picks up after it.
+A dry run reads the checkpoint but doesn't update it.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import os
+import sys
+import time
+from google.api_core import exceptions
+from google.cloud import firestore
+
+from model import model
+
+# Firestore's limit on writes in a single commit.
+MAX_BATCH_SIZE = 500
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip() or None
+    return None
+
+
+def write_checkpoint(path, order_id):
+    if not path:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(order_id)
+    os.replace(tmp_path, path)
+
+
+def changed_totals(orders, prices, stats):
+    """Yields (order, new total) for each order whose total is stale."""
+    for order in orders:
+        stats['scanned'] += 1
+        try:
+            total = sum(item.get_price(prices) for item in order.items)
+        except KeyError as e:
+            logging.warning('Skipping %s, unknown menu item %s', order.path, e)
+            stats['errors'] += 1
+            continue
+        if total != order.total:
+            stats['changed'] += 1
+            yield order, total
+
+
+def reprice_order(ref, prices):
+    """Re-reads the order at ref and writes its total, if still open and
+    stale, repricing it again if it changes meanwhile.
+
+    Returns a Counter of the orders written and skipped.
+    """
+    def update(order):
+        if not order.done:
+            order.updateTotal(prices)
+
+    order = model.Order(ref)
+    try:
+        return collections.Counter(written=int(order.set(update)))
+    except KeyError as e:
+        logging.warning('Skipping %s, unknown menu item %s', order.path, e)
+    except exceptions.FailedPrecondition:
+        logging.warning('Skipping %s, it kept changing', order.path)
+    return collections.Counter(errors=1)
+
+
+def commit_batch(db, updates, prices):
+    """Writes the new totals, each only if its order is unchanged since read.
+
+    Returns a Counter of the orders written and skipped.
+    """
+    batch = db.batch()
+    for order, total in updates:
+        batch.update(order.ref, {
+            'totalPrice': total,
+            model.UPDATED_FIELD: firestore.SERVER_TIMESTAMP,
+        }, option=db.write_option(last_update_time=order.date))
+    try:
+        batch.commit()
+    except exceptions.FailedPrecondition:
+        # Some order changed, which fails the whole batch.
+        stats = collections.Counter(conflicts=1)
+        for order, _ in updates:
+            stats.update(reprice_order(order.ref, prices))
+        return stats
+    return collections.Counter(written=len(updates))
+
+
+def reprice(db, location=model.DEFAULT_LOCATION, dry_run=False,
+            checkpoint=None, page_size=MAX_BATCH_SIZE, workers=8):
+    prices = model.PriceSheet(model.AllDishes(db, location))
+    stats = collections.Counter()
+    query = model.OrdersCollection(db, location).where('done', '==', False)
+    start = time.perf_counter()
+    # (last order id, commit futures) for each page not yet checkpointed,
+    # oldest first.
+    pending = collections.deque()
+
+    def drain(keep):
+        """Checkpoint finished pages, waiting until at most `keep` remain."""
+        while pending:
+            last_id, futures = pending[0]
+            if len(pending) <= keep and not all(f.done() for f in futures):
+                return
+            for f in futures:
+                stats.update(f.result())
+            pending.popleft()
+            if not dry_run:
+                write_checkpoint(checkpoint, last_id)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pages = model.OrderPages(query, page_size,
+                                 start_after=read_checkpoint(checkpoint))
+        for page in pages:
+            updates = list(changed_totals(page, prices, stats))
+            if dry_run:
+                for order, total in updates:
+                    print('%s: %s -> %s' % (order.path, order.total, total))
+                updates = []
+            futures = [
+                pool.submit(commit_batch, db, updates[i:i + MAX_BATCH_SIZE],
+                            prices)
+                for i in range(0, len(updates), MAX_BATCH_SIZE)
+            ]
+            pending.append((page[-1].id, futures))
+            # Bound the number of pages held in memory.
+            drain(keep=workers)
+        drain(keep=0)
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--location', default=model.DEFAULT_LOCATION,
+                        help='The location whose orders to reprice.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report stale totals without writing them.')
+    parser.add_argument('--checkpoint',
+                        help='File recording progress, for resuming.')
+    parser.add_argument('--page-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    stats = reprice(firestore.Client(), args.location, args.dry_run,
+                    args.checkpoint, args.page_size, args.workers)
+    rate = stats['scanned'] / max(stats['seconds'], 1e-9)
+    print('Scanned %d open orders in %.1fs (%.1f orders/s): %d stale, '
+          '%d written, %d skipped, %d batches retried after conflicts' %
+          (stats['scanned'], stats['seconds'], rate, stats['changed'],
+           stats['written'], stats['errors'], stats['conflicts']))
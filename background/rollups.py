@@ -0,0 +1,223 @@
+"""Incrementally maintained sales rollups.
+
+Each paid order (one with a payment token) counts towards the rollups for
+the UTC day and hour it was created in:
+
+  orders    -- the number of orders,
+  revenue   -- the sum of their `totalPrice`,
+  dishes    -- how many of each dish were sold,
+  choices   -- how many times each ingredient choice was picked.
+
+`record_event` is called by `background` for every order write. It compares
+the order's contribution before and after the write, and adds the difference
+to one randomly-chosen shard of each affected rollup (see model.RollupRef),
+in a transaction which also records the event id so that redelivered events
+are only counted once.
+
+Each event id is kept in a stats_events document which expires after
+EVENT_MARKER_TTL, once the event can no longer be redelivered. To have
+Firestore delete them then, enable a TTL policy on their `expires` field:
+  gcloud firestore fields ttls update expires --collection-group=stats_events
+or delete expired ones from time to time with:
+  python rollups.py --location ID --prune-events
+
+To backfill, or to recover from drift, rebuild a location's rollups from
+its orders with:
+  python rollups.py --location ID
+
+Rebuild when no orders are being written; events processed during a rebuild
+may be lost or double counted.
+"""
+
+import argparse
+import collections
+import datetime
+import logging
+import random
+import sys
+from google.cloud import firestore
+
+from model import model
+
+# How long to remember an event id. Cloud Functions stops retrying an event
+# after 7 days.
+EVENT_MARKER_TTL = datetime.timedelta(days=7)
+
+
+def decode_value(value: dict):
+    """Decodes a value from a Firestore event payload."""
+    if 'mapValue' in value:
+        return decode_fields(value['mapValue'].get('fields', {}))
+    if 'arrayValue' in value:
+        return [decode_value(x) for x in value['arrayValue'].get('values', [])]
+    if 'integerValue' in value:
+        return int(value['integerValue'])
+    if 'doubleValue' in value:
+        return float(value['doubleValue'])
+    if 'nullValue' in value:
+        return None
+    for kind in ('stringValue', 'booleanValue', 'timestampValue',
+                 'referenceValue'):
+        if kind in value:
+            return value[kind]
+    return None
+
+
+def decode_fields(fields: dict):
+    return {k: decode_value(v) for k, v in fields.items()}
+
+
+def periods(when):
+    """Returns the day and hour rollups for when.
+
+    when is a datetime, or an RFC 3339 string as used in event payloads.
+    """
+    if not isinstance(when, str):
+        when = when.strftime('%Y-%m-%dT%H')
+    return [when[:10], when[:13]]
+
+
+def contribution(order: dict):
+    """Returns the counts a single order adds to its rollups."""
+    if not order.get('token'):
+        return {}
+    dishes = collections.Counter()
+    choices = collections.Counter()
+    for item in order.get('items', []):
+        item = dict(item)
+        dishes[item.pop('item', None)] += 1
+        for selected in item.values():
+            if isinstance(selected, str):
+                selected = [selected]
+            choices.update(selected)
+    return {
+        'orders': 1,
+        'revenue': order.get('totalPrice') or 0,
+        'dishes': dict(dishes),
+        'choices': dict(choices),
+    }
+
+
+def _prune(counts: dict):
+    """Removes zero counts, returning whether any remain."""
+    for key in list(counts):
+        value = counts[key]
+        if isinstance(value, dict) and _prune(value):
+            continue
+        if value and not isinstance(value, dict):
+            continue
+        del counts[key]
+    return bool(counts)
+
+
+def deltas(old: dict, new: dict, event_time: str):
+    """Returns {period: counts} to add to the rollups for a write."""
+    result = collections.defaultdict(dict)
+    for order, sign in ((old, -1), (new, 1)):
+        counts = contribution(order)
+        if not counts:
+            continue
+        for period in periods(order.get('created') or event_time):
+            model.add_counts(result[period], counts, sign)
+    return {k: v for k, v in result.items() if _prune(v)}
+
+
+@firestore.transactional
+def _apply(transaction, marker, updates, expires):
+    if marker.get(transaction=transaction).exists:
+        return False
+    shards = [ref.get(transaction=transaction) for ref, _ in updates]
+    for (ref, delta), shard in zip(updates, shards):
+        transaction.set(ref, model.add_counts(shard.to_dict() or {}, delta))
+    transaction.create(marker, {
+        'at': firestore.SERVER_TIMESTAMP,
+        'expires': expires,
+    })
+    return True
+
+
+def record_event(db, location, data, context):
+    """Updates location's rollups for an order write event."""
+    old = decode_fields(data.get('oldValue', {}).get('fields', {}))
+    new = decode_fields(data.get('value', {}).get('fields', {}))
+    changes = deltas(old, new, context.timestamp)
+    if not changes:
+        return
+    shard = str(random.randrange(model.ROLLUP_SHARDS))
+    updates = [(model.RollupRef(db, location, period).collection(
+        'shards').document(shard), delta)
+               for period, delta in sorted(changes.items())]
+    marker = model.LocationRef(db, location).collection(
+        'stats_events').document(context.event_id)
+    expires = datetime.datetime.now(datetime.timezone.utc) + EVENT_MARKER_TTL
+    if not _apply(db.transaction(), marker, updates, expires):
+        logging.info('Already counted event %s', context.event_id)
+
+
+def prune_events(db, location):
+    """Deletes location's expired event markers, returning how many."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    query = model.LocationRef(db, location).collection(
+        'stats_events').where('expires', '<', now).select([])
+    deleted = 0
+    batch = db.batch()
+    for marker in query.stream():
+        batch.delete(marker.reference)
+        deleted += 1
+        if deleted % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    return deleted
+
+
+def rebuild(db, location):
+    """Recomputes all of location's rollups from its orders."""
+    totals = collections.defaultdict(dict)
+    query = model.OrdersCollection(db, location)
+    for page in model.OrderPages(query):
+        for order in page:
+            data = order.as_dict()
+            when = data.get('created') or order.date.ToDatetime()
+            for period in periods(when):
+                model.add_counts(totals[period], contribution(data))
+
+    stats = model.LocationRef(db, location).collection('stats')
+    batch = db.batch()
+    writes = 0
+    for rollup in stats.list_documents():
+        for shard in rollup.collection('shards').list_documents():
+            batch.delete(shard)
+            writes += 1
+            if writes % 500 == 0:
+                batch.commit()
+                batch = db.batch()
+    for period, counts in sorted(totals.items()):
+        if not _prune(counts):
+            continue
+        batch.set(model.RollupRef(db, location, period).collection(
+            'shards').document('0'), counts)
+        writes += 1
+        if writes % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    return len(totals)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description='Rebuild sales rollups.')
+    parser.add_argument('--location', default=model.DEFAULT_LOCATION,
+                        help='The location whose rollups to rebuild.')
+    parser.add_argument('--prune-events', action='store_true',
+                        help='Delete expired event ids instead of rebuilding.')
+    args = parser.parse_args()
+
+    if args.prune_events:
+        count = prune_events(firestore.Client(), args.location)
+        print('Deleted %d event ids for %s' % (count, args.location))
+    else:
+        count = rebuild(firestore.Client(), args.location)
+        print('Rebuilt %d rollups for %s' % (count, args.location))
@@ -0,0 +1,377 @@
+"""Simulate a storm of order writes against the `background` function.
+
+Order writes, synthetic or replayed from a file, are made to an in-memory
+Firestore (fake_firestore.py) which, like the real one, triggers
+`background` for every write to an order, including the function's own.
+The real function code runs against it on virtual time: each Firestore RPC
+takes about --latency seconds, the reconciler's sleep blocks only its own
+invocation, and invocations start --trigger-delay seconds after the write
+which caused them. A simulated hour takes seconds to run.
+
+Usage:
+  python simulate.py [--orders N] [--rate PER_SECOND] [--items N]
+                     [--paid FRACTION] [--untotaled FRACTION] [--record FILE]
+  python simulate.py --replay FILE
+
+Synthetic orders are written the way the voice webhook writes them: a new
+order document, then one update per item added, then (for --paid of them)
+the payment token. --untotaled of them leave totalPrice unset for
+`background` to fill in, as older clients did.
+
+--record saves the writes made as newline-delimited JSON, one write per
+line, e.g.
+  {"t": 1.5, "op": "update", "path": "locations/default/orders/x",
+   "data": {"token": {"id": "tok_1"}}}
+where t is seconds since the start, op is create, set, update or delete, and
+the string "SERVER_TIMESTAMP" stands for firestore.SERVER_TIMESTAMP. Such a
+file, edited or written by hand, can be given to --replay.
+"""
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import types
+from google.cloud import firestore
+
+import fake_firestore
+from model import model
+
+LOCATION = model.DEFAULT_LOCATION
+
+# The menu synthetic orders are placed from.
+DISHES = {
+    'grain bowl': {
+        'price': 9.5,
+        'ingredients': {
+            'base': {'max': 1, 'names': ['rice', 'quinoa'], 'charge': 0},
+            'extras': {'max': 2, 'names': ['avocado', 'egg'], 'charge': 1.5},
+        },
+    },
+    'salad': {
+        'price': 8,
+        'ingredients': {
+            'greens': {'max': 1, 'names': ['kale', 'romaine'], 'charge': 0},
+            'dressing': {'max': 1, 'names': ['lemon', 'tahini'], 'charge': 0},
+        },
+    },
+    'soup': {'price': 6, 'ingredients': {}},
+}
+
+
+class Scheduler:
+    """Runs simulated processes, one at a time, on virtual time.
+
+    Each process is a thread, but only one runs at once: `sleep` hands
+    control back to `run`, which resumes whichever process is due next.
+    """
+
+    def __init__(self, start):
+        self.now = start
+        self._queue = []
+        self._sequence = itertools.count()
+        self._idle = threading.Event()
+
+    def _wake_at(self, at, event):
+        heapq.heappush(self._queue, (at, next(self._sequence), event))
+
+    def spawn(self, at, fn, *args):
+        """Starts fn(*args) as a process at virtual time at."""
+        wake = threading.Event()
+
+        def process():
+            wake.wait()
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('Simulated process failed')
+            finally:
+                self._idle.set()
+
+        threading.Thread(target=process, daemon=True).start()
+        self._wake_at(at, wake)
+
+    def sleep(self, seconds):
+        """Blocks the current process for seconds of virtual time."""
+        wake = threading.Event()
+        self._wake_at(self.now + seconds, wake)
+        self._idle.set()
+        wake.wait()
+
+    def run(self):
+        while self._queue:
+            at, _, wake = heapq.heappop(self._queue)
+            self.now = max(self.now, at)
+            self._idle.clear()
+            wake.set()
+            self._idle.wait()
+
+
+def synthetic_writes(args, prices):
+    """Yields (t, op, path, data) for a stream of synthetic orders."""
+    rng = random.Random(args.seed)
+    arrival = 0
+    for n in range(args.orders):
+        arrival += rng.expovariate(args.rate)
+        path = 'locations/%s/orders/sim%06d' % (LOCATION, n)
+        t = arrival
+        yield t, 'create', path, {
+            'user': 'user%d' % rng.randrange(args.orders),
+            'done': False,
+            'items': [],
+            'token': {},
+            'totalPrice': 0,
+            'created': firestore.SERVER_TIMESTAMP,
+        }
+        untotaled = rng.random() < args.untotaled
+        items = []
+        count = max(1, round(fake_firestore.exponential(rng, args.items)))
+        for _ in range(count):
+            t += fake_firestore.exponential(rng, args.think_time)
+            dish = rng.choice(sorted(DISHES))
+            item = {'item': dish}
+            for category, spec in DISHES[dish]['ingredients'].items():
+                item[category] = rng.sample(
+                    spec['names'], rng.randint(1, spec['max']))
+            items.append(item)
+            update = {'items': list(items)}
+            if not untotaled:
+                update['totalPrice'] = sum(
+                    model.OrderItem(**x).get_price(prices) for x in items)
+            yield t, 'update', path, update
+        if rng.random() < args.paid:
+            t += fake_firestore.exponential(rng, args.think_time)
+            yield t, 'update', path, {'token': {'id': 'tok_%d' % n}}
+
+
+def _encode(data):
+    if data is firestore.SERVER_TIMESTAMP:
+        return 'SERVER_TIMESTAMP'
+    if isinstance(data, dict):
+        return {k: _encode(v) for k, v in data.items()}
+    return data
+
+
+def _decode(data):
+    if data == 'SERVER_TIMESTAMP':
+        return firestore.SERVER_TIMESTAMP
+    if isinstance(data, dict):
+        return {k: _decode(v) for k, v in data.items()}
+    return data
+
+
+def recorded_writes(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                write = json.loads(line)
+                yield (write['t'], write['op'], write['path'],
+                       _decode(write.get('data')))
+
+
+def percentiles(samples):
+    if not samples:
+        return 'n/a'
+    samples = sorted(samples)
+    at = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))]
+    return 'p50 %.1f  p95 %.1f  p99 %.1f  max %.1f' % (
+        at(0.5), at(0.95), at(0.99), samples[-1])
+
+
+def _paid(fields):
+    return bool(fields.get('token', {}).get('mapValue', {}).get('fields'))
+
+
+class Simulation:
+    def __init__(self, scheduler, store, main, trigger_delay):
+        self.scheduler = scheduler
+        self.store = store
+        self.main = main
+        self.trigger_delay = trigger_delay
+        self.start = scheduler.now
+        self._local = threading.local()
+        self.created = {}
+        self.paid = {}
+        self.completed = {}
+        self.invocations = collections.Counter()
+        self.self_triggered = collections.Counter()
+        self.io = collections.defaultdict(collections.Counter)
+        self.blocked = collections.Counter()
+        self.durations = []
+        self.failures = 0
+        self.client_failures = 0
+
+    def on_write(self, data, context):
+        """Called by the store for each order write; triggers background."""
+        path = self.main._document_path(context)
+        old = data['oldValue'].get('fields', {})
+        new = data['value'].get('fields', {})
+        now = self.scheduler.now
+        if _paid(new) and not _paid(old):
+            self.paid.setdefault(path, now)
+        if (new.get('done', {}).get('booleanValue') and
+                not old.get('done', {}).get('booleanValue')):
+            self.completed.setdefault(path, now)
+        if getattr(self._local, 'order', None):
+            self.self_triggered[path] += 1
+        self.scheduler.spawn(now + self.trigger_delay, self.invoke, path,
+                             data, context)
+
+    def sleep(self, seconds):
+        """Stands in for time.sleep in the background function."""
+        self.blocked[self._local.order] += seconds
+        self.scheduler.sleep(seconds)
+
+    def invoke(self, path, data, context):
+        self._local.order = path
+        self.invocations[path] += 1
+        start = self.scheduler.now
+        with self.store.tally() as counts:
+            try:
+                self.main.background(data, context)
+            except Exception:
+                logging.exception('background failed for %s', path)
+                self.failures += 1
+        self.io[path].update(counts)
+        self.durations.append(self.scheduler.now - start)
+        self._local.order = None
+
+    def client(self, path, writes):
+        """Makes one order's writes in turn, as its conversation would."""
+        ref = self.store.document(path)
+        for t, op, data in writes:
+            self.scheduler.sleep(max(0, self.start + t - self.scheduler.now))
+            try:
+                if op in ('create', 'set'):
+                    self.created.setdefault(path, self.scheduler.now)
+                    getattr(ref, op)(data)
+                elif op == 'update':
+                    ref.update(data)
+                elif op == 'delete':
+                    ref.delete()
+            except Exception:
+                logging.exception('Client %s of %s failed', op, path)
+                self.client_failures += 1
+
+    def report(self, seconds):
+        orders = len(self.created) or 1
+        invocations = sum(self.invocations.values())
+        io = collections.Counter()
+        for counts in self.io.values():
+            io.update(counts)
+        per_order = sorted(self.invocations[x] for x in self.created)
+        print('Orders: %d written, %d paid, %d completed; %d client writes '
+              'failed' % (len(self.created), len(self.paid),
+                          len(self.completed), self.client_failures))
+        print('Invocations: %d (%d triggered by background itself), '
+              '%d failed' % (invocations, sum(self.self_triggered.values()),
+                             self.failures))
+        print('Invocations per order: mean %.1f  max %d' %
+              (invocations / orders, per_order[-1] if per_order else 0))
+        print('Background I/O per order: %.1f RPCs, %.1f reads, %.1f writes' %
+              (io['rpcs'] / orders, io['reads'] / orders,
+               io['writes'] / orders))
+        print('Blocked in sleep: %.0fs in total, %.1fs per order' %
+              (sum(self.blocked.values()),
+               sum(self.blocked.values()) / orders))
+        print('Invocation duration (s):       %s' %
+              percentiles(self.durations))
+        print('Created to completed (s):      %s' % percentiles(
+            [t - self.created[x] for x, t in self.completed.items()
+             if x in self.created]))
+        print('Paid to completed (s):         %s' % percentiles(
+            [t - self.paid[x] for x, t in self.completed.items()
+             if x in self.paid]))
+        print('Simulated %.0fs in %.1fs' % (
+            self.scheduler.now - self.start, seconds))
+
+
+def seed_menu(store):
+    location = model.LocationRef(store, LOCATION)
+    for name, dish in DISHES.items():
+        ref = location.collection('dishes').document(name)
+        ref.set({'price': dish['price']})
+        for category, ingredient in dish['ingredients'].items():
+            ref.collection('ingredients').document(category).set(ingredient)
+    menu = model.Menu(model.AllDishes(store, LOCATION))
+    model.MenuRef(store, LOCATION).set(menu.as_dict())
+    return menu
+
+
+def simulate(args):
+    scheduler = Scheduler(time.time())
+    store = fake_firestore.Client(clock=lambda: scheduler.now,
+                                  sleep=scheduler.sleep)
+    # The function module creates its client on import.
+    firestore.Client = lambda *args, **kwargs: store
+    import main
+
+    simulation = Simulation(scheduler, store, main, args.trigger_delay)
+    main.time = types.SimpleNamespace(sleep=simulation.sleep)
+    menu = seed_menu(store)
+    # Latencies get their own generator, so that they don't change the
+    # synthetic writes, and are reproducible with the same --seed.
+    latencies = random.Random('%s/latency' % args.seed)
+    store.latency = lambda: fake_firestore.exponential(latencies, args.latency)
+    store.on_write('locations/*/orders/*', simulation.on_write)
+
+    if args.replay:
+        writes = recorded_writes(args.replay)
+    else:
+        writes = synthetic_writes(args, menu.prices)
+    record = open(args.record, 'w') if args.record else None
+    orders = collections.defaultdict(list)
+    for t, op, path, data in writes:
+        orders[path].append((t, op, data))
+        if record:
+            record.write(json.dumps({'t': round(t, 3), 'op': op,
+                                     'path': path, 'data': _encode(data)}))
+            record.write('\n')
+    if record:
+        record.close()
+    for path, order_writes in orders.items():
+        order_writes.sort(key=lambda x: x[0])
+        scheduler.spawn(simulation.start + order_writes[0][0],
+                        simulation.client, path, order_writes)
+
+    begin = time.perf_counter()
+    scheduler.run()
+    simulation.report(time.perf_counter() - begin)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--orders', type=int, default=200,
+                        help='How many synthetic orders to write.')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='New orders per second.')
+    parser.add_argument('--items', type=float, default=2,
+                        help='Mean number of items per order.')
+    parser.add_argument('--think-time', type=float, default=5,
+                        help='Mean seconds between writes to an order.')
+    parser.add_argument('--paid', type=float, default=0.9,
+                        help='Fraction of orders which are paid for.')
+    parser.add_argument('--untotaled', type=float, default=0,
+                        help='Fraction of orders written without a total.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Mean seconds per Firestore RPC.')
+    parser.add_argument('--trigger-delay', type=float, default=0.5,
+                        help='Seconds from a write to its invocation.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic writes and latencies.')
+    parser.add_argument('--replay',
+                        help='Replay the writes recorded in this file.')
+    parser.add_argument('--record',
+                        help='Save the writes made to this file.')
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error('--rate must be positive')
+    simulate(args)
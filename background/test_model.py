@@ -0,0 +1,74 @@
+"""Tests of Order.set's handling of concurrent writes, against the in-memory
+Firestore in fake_firestore.py.
+
+  python -m unittest test_model
+"""
+
+import unittest
+from google.api_core import exceptions
+
+import fake_firestore
+from model import model
+
+PRICES = {'soup': 6, 'salad': 8}
+
+
+def total(order):
+    order.updateTotal(PRICES)
+
+
+def complete(order):
+    order.updateTotal(PRICES)
+    order.done = True
+
+
+class OrderSetTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_firestore.Client()
+        self.ref = model.OrdersCollection(self.db).document('o1')
+
+    def test_conflict_recomputes_from_fresh_read(self):
+        self.ref.create({'user': 'u1', 'items': [{'item': 'soup'}],
+                         'totalPrice': 6})
+        a = model.Order(self.ref)
+        b = model.Order(self.ref)
+        b.items.append(model.OrderItem(item='salad'))
+        b.updateTotal(PRICES)
+        self.assertTrue(b.set())
+
+        self.assertTrue(a.set(complete))
+        saved = self.ref.get().to_dict()
+        self.assertEqual(len(saved['items']), 2)
+        self.assertEqual(saved['totalPrice'], 14)
+        self.assertTrue(saved['done'])
+
+    def test_conflict_without_update_is_raised(self):
+        self.ref.create({'user': 'u1', 'items': [], 'totalPrice': 0})
+        a = model.Order(self.ref)
+        self.ref.update({'totalPrice': 8})
+        a.total = 6
+        with self.assertRaises(exceptions.FailedPrecondition):
+            a.set()
+        self.assertEqual(self.ref.get().get('totalPrice'), 8)
+
+    def test_defaults_of_unread_fields_are_not_written(self):
+        # As left by add(), which creates an empty order before setting it.
+        self.ref.create({})
+        order = model.Order(self.ref)
+        self.assertEqual(order.changes(), {})
+        self.ref.set({'user': 'u1', 'items': [{'item': 'salad'}]})
+
+        self.assertTrue(order.set(total))
+        saved = self.ref.get().to_dict()
+        self.assertEqual(saved['user'], 'u1')
+        self.assertEqual(saved['totalPrice'], 8)
+        self.assertNotIn('done', saved)
+
+    def test_unchanged_order_is_not_written(self):
+        self.ref.create({'user': 'u1', 'items': [], 'totalPrice': 0})
+        order = model.Order(self.ref)
+        self.assertFalse(order.set(lambda order: None))
+
+
+if __name__ == '__main__':
+    unittest.main()
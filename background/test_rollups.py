@@ -0,0 +1,130 @@
+"""Tests of the sales rollups kept by rollups.py, from order write events.
+
+  python -m unittest test_rollups
+"""
+
+import datetime
+import types
+import unittest
+
+import fake_firestore
+import rollups
+from model import model
+
+CREATED = datetime.datetime(2019, 4, 9, 13, 5, tzinfo=datetime.timezone.utc)
+EVENT_TIME = '2019-04-10T08:00:00.000Z'
+
+ITEMS = [
+    {'item': 'grain bowl', 'base': 'rice', 'extras': ['egg', 'avocado']},
+    {'item': 'soup'},
+]
+
+
+def order(**fields):
+    data = {'user': 'u1', 'done': False, 'items': ITEMS, 'token': {},
+            'totalPrice': 17, 'created': CREATED}
+    data.update(fields)
+    return data
+
+
+def event(old, new, event_id='e1'):
+    """Returns (data, context) for a write of an order from old to new."""
+    data = {}
+    for key, fields in (('oldValue', old), ('value', new)):
+        data[key] = {}
+        if fields:
+            data[key]['fields'] = fake_firestore.encode_fields(fields)
+    context = types.SimpleNamespace(event_id=event_id, timestamp=EVENT_TIME)
+    return data, context
+
+
+def deltas(old, new):
+    data, context = event(old, new)
+    return rollups.deltas(
+        rollups.decode_fields(data['oldValue'].get('fields', {})),
+        rollups.decode_fields(data['value'].get('fields', {})),
+        context.timestamp)
+
+
+PAID = {
+    'orders': 1,
+    'revenue': 17,
+    'dishes': {'grain bowl': 1, 'soup': 1},
+    'choices': {'rice': 1, 'egg': 1, 'avocado': 1},
+}
+
+
+class DeltasTest(unittest.TestCase):
+    def test_unpaid_orders_are_not_counted(self):
+        self.assertEqual(deltas(None, order()), {})
+        self.assertEqual(deltas(order(), order(totalPrice=20)), {})
+
+    def test_payment_counts_the_order_in_its_day_and_hour(self):
+        self.assertEqual(deltas(order(), order(token={'id': 'tok'})),
+                         {'2019-04-09': PAID, '2019-04-09T13': PAID})
+
+    def test_reprice_adds_only_the_difference(self):
+        paid = order(token={'id': 'tok'})
+        self.assertEqual(deltas(paid, dict(paid, totalPrice=20)),
+                         {'2019-04-09': {'revenue': 3},
+                          '2019-04-09T13': {'revenue': 3}})
+
+    def test_unrelated_changes_add_nothing(self):
+        paid = order(token={'id': 'tok'})
+        self.assertEqual(deltas(paid, dict(paid, done=True)), {})
+
+    def test_deleting_a_paid_order_subtracts_it(self):
+        removed = deltas(order(token={'id': 'tok'}), None)
+        self.assertEqual(removed['2019-04-09']['orders'], -1)
+        self.assertEqual(removed['2019-04-09']['dishes'],
+                         {'grain bowl': -1, 'soup': -1})
+
+    def test_orders_without_created_count_at_the_event_time(self):
+        paid = order(token={'id': 'tok'})
+        del paid['created']
+        self.assertEqual(sorted(deltas(None, paid)),
+                         ['2019-04-10', '2019-04-10T08'])
+
+    def test_prune_drops_zeros_and_empty_maps(self):
+        counts = {'orders': 0, 'revenue': 2, 'dishes': {'soup': 0},
+                  'choices': {'egg': 1, 'rice': 0}}
+        self.assertTrue(rollups._prune(counts))
+        self.assertEqual(counts, {'revenue': 2, 'choices': {'egg': 1}})
+        self.assertFalse(rollups._prune({'orders': 0, 'dishes': {}}))
+
+
+class RecordEventTest(unittest.TestCase):
+    def setUp(self):
+        self.db = fake_firestore.Client()
+
+    def record(self, old, new, event_id):
+        rollups.record_event(self.db, model.DEFAULT_LOCATION,
+                             *event(old, new, event_id))
+
+    def rollup(self, period):
+        return model.Rollup(self.db, model.DEFAULT_LOCATION, period)
+
+    def test_pay_then_reprice(self):
+        unpaid = order()
+        paid = order(token={'id': 'tok'})
+        self.record(None, unpaid, 'e1')
+        self.record(unpaid, paid, 'e2')
+        self.record(paid, dict(paid, totalPrice=20), 'e3')
+        expected = dict(PAID, revenue=20)
+        self.assertEqual(self.rollup('2019-04-09'), expected)
+        self.assertEqual(self.rollup('2019-04-09T13'), expected)
+
+    def test_redelivered_events_count_once(self):
+        paid = order(token={'id': 'tok'})
+        self.record(order(), paid, 'e1')
+        self.record(order(), paid, 'e1')
+        self.assertEqual(self.rollup('2019-04-09'), PAID)
+
+    def test_unpaid_orders_write_nothing(self):
+        self.record(None, order(), 'e1')
+        self.assertEqual(self.rollup('2019-04-09'), {})
+        self.assertEqual(self.db.stats['writes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
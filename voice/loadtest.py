@@ -0,0 +1,411 @@
+"""Load test the voice webhook with conversations built from the agent export.
+
+Each synthetic conversation follows the ordering flow
+  buy -> start -> add (x N) -> checkout -> receipt
+with utterances taken from the intents' examples in dialogflow/intents, and
+entity slots filled from the entries in dialogflow/entities. The output
+contexts of each response are carried into the next request, as Dialogflow
+does, so later turns see the order's state.
+
+Requests are passed straight to `main.voice`, which runs against an
+in-memory Firestore (fake_firestore.py) whose RPCs each take about
+--latency seconds. Its menu is seeded from the bundled snapshot for LOCATION
+(see make_entities.py) if there is one, otherwise from the entities.
+
+Usage:
+  python loadtest.py [--concurrency 1,2,4,8,16,32,64] [--duration SECONDS]
+                     [--items N] [--think-time SECONDS] [--latency SECONDS]
+                     [--deadline SECONDS]
+
+Each concurrency level runs that many conversations at once, back to back,
+for --duration seconds. For each level, the report gives the throughput,
+per-intent latency percentiles, the turns slower than --deadline (Dialogflow
+gives up on a webhook after 5 seconds) and the turns turned away as busy by
+the rate limiter, whose limits come from the environment as in production
+(see model/ratelimit.py). Busy turns are retried after a second, as a user
+would. It ends with the first level at which deadlines were missed, turns
+failed or conversations were abandoned.
+"""
+
+import argparse
+import collections
+import contextlib
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from google.cloud import firestore
+
+import fake_firestore
+import menu_index
+from model import model
+
+AGENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'dialogflow')
+
+# Entities which aren't a category of ingredients.
+NON_INGREDIENT_ENTITIES = {'Dishes', 'Ingredients'}
+
+
+class Agent:
+    """The intents' example utterances and the entities' entries."""
+
+    def __init__(self, directory=AGENT_DIR):
+        # intent name -> [example, as a list of text and entity segments]
+        self.examples = {}
+        self.intent_ids = {}
+        for path in glob.glob(os.path.join(directory, 'intents', '*.json')):
+            if path.endswith('_usersays_en.json'):
+                continue
+            with open(path) as f:
+                intent = json.load(f)
+            self.intent_ids[intent['name']] = intent['id']
+            examples = path[:-len('.json')] + '_usersays_en.json'
+            if os.path.exists(examples):
+                with open(examples) as f:
+                    self.examples[intent['name']] = [
+                        x['data'] for x in json.load(f)]
+        # entity name -> {value: synonyms}
+        self.entities = {}
+        suffix = '_entries_en.json'
+        for path in glob.glob(os.path.join(directory, 'entities',
+                                           '*' + suffix)):
+            with open(path) as f:
+                self.entities[os.path.basename(path)[:-len(suffix)]] = {
+                    x['value']: x.get('synonyms') or [x['value']]
+                    for x in json.load(f)}
+
+    def utterance(self, rng, intent, **values):
+        """Returns (text, parameters) for one of intent's examples.
+
+        Entity slots are filled with values[alias] if given, or else a random
+        entry, said as one of its synonyms.
+        """
+        examples = self.examples.get(intent)
+        if not examples:
+            # Intents triggered by events have no examples.
+            return intent, {}
+        text = []
+        parameters = {}
+        for segment in rng.choice(examples):
+            alias = segment.get('alias')
+            if not alias or not segment.get('meta', '').startswith('@'):
+                text.append(segment['text'])
+                continue
+            entries = self.entities[segment['meta'][1:]]
+            value = values.get(alias) or rng.choice(sorted(entries))
+            text.append(rng.choice(entries.get(value) or [value]))
+            parameters[alias] = value
+        return ''.join(text), parameters
+
+    def menu(self):
+        """Builds a Menu from the entities, offering every ingredient with
+        every dish."""
+        ingredients = {
+            name.lower(): {
+                'max': 0,
+                'names': sorted(entries),
+                'charge': 1.5 if name == 'Premium' else 0,
+            }
+            for name, entries in self.entities.items()
+            if name not in NON_INGREDIENT_ENTITIES
+        }
+        dishes = {
+            name: {'price': 8 + n, 'ingredients': ingredients}
+            for n, name in enumerate(sorted(self.entities['Dishes']))
+        }
+        return model.Menu.from_dict({'dishes': dishes})
+
+
+class Request:
+    """The parts of a Flask request which main.voice uses."""
+
+    path = '/'
+    headers = {}
+
+    def __init__(self, body):
+        self._body = body
+
+    def get_json(self):
+        return self._body
+
+
+class Conversation:
+    def __init__(self, agent, menu, rng):
+        self.agent = agent
+        self.menu = menu
+        self.rng = rng
+        self.session = 'projects/loadtest/agent/sessions/' + uuid.uuid4().hex
+        # context name -> context, as returned by the webhook.
+        self.contexts = {}
+
+    def request(self, intent, text, parameters, arguments=()):
+        return {
+            'responseId': uuid.uuid4().hex,
+            'session': self.session,
+            'queryResult': {
+                'queryText': text,
+                'parameters': parameters,
+                'allRequiredParamsPresent': True,
+                'outputContexts': list(self.contexts.values()),
+                'intent': {
+                    'name': 'projects/loadtest/agent/intents/' +
+                            self.agent.intent_ids.get(intent, intent),
+                    'displayName': intent,
+                },
+                'languageCode': 'en',
+            },
+            'originalDetectIntentRequest': {
+                'source': 'google',
+                'payload': {
+                    'inputs': [{'arguments': list(arguments)}],
+                    'user': {},
+                },
+            },
+        }
+
+    def add_parameters(self):
+        dish = self.rng.choice(self.menu.dishes)
+        text, parameters = self.agent.utterance(self.rng, 'add',
+                                                Dish=dish.name)
+        # The example's ingredients may not go with the dish, so choose them
+        # from its own.
+        parameters = {'Dish': parameters['Dish']}
+        for category in dish.ingredients:
+            if not category.choices or self.rng.random() < 0.5:
+                continue
+            limit = category.max_items or 2
+            entity = menu_index.entity_name(category.name)
+            parameters[entity] = self.rng.sample(
+                category.choices,
+                self.rng.randint(1, min(limit, len(category.choices))))
+        return text, parameters
+
+    def turns(self, items):
+        """Yields (intent, text, parameters, arguments) for each turn."""
+        yield ('buy', *self.agent.utterance(self.rng, 'buy'), [])
+        yield ('start', 'actions_intent_TRANSACTION_REQUIREMENTS_CHECK', {},
+               [{'name': 'TRANSACTION_REQUIREMENTS_CHECK_RESULT',
+                 'extension': {'resultType': 'OK'}}])
+        for _ in range(items):
+            yield ('add', *self.add_parameters(), [])
+        yield ('checkout', *self.agent.utterance(self.rng, 'checkout'), [])
+        yield ('receipt', 'actions_intent_TRANSACTION_DECISION', {}, [{
+            'name': 'TRANSACTION_DECISION_VALUE',
+            'extension': {
+                'checkResult': {'resultType': 'OK'},
+                'userDecision': 'ORDER_ACCEPTED',
+                'order': {'paymentInfo': {'googleProvidedPaymentInstrument': {
+                    'instrumentToken': 'tok_' + uuid.uuid4().hex[:12]}}},
+            },
+        }])
+
+    def turn(self, main, intent, text, parameters, arguments):
+        """Sends one turn to the webhook.
+
+        Returns how long it took, and whether it was turned away as busy.
+        """
+        body = self.request(intent, text, parameters, arguments)
+        start = time.perf_counter()
+        result = json.loads(main.voice(Request(body)))
+        seconds = time.perf_counter() - start
+        for context in result.get('outputContexts', []):
+            self.contexts[context['name']] = context
+        return seconds, result.get('fulfillmentText') == main.BUSY_MESSAGE
+
+
+def seed(store, agent):
+    """Writes the app settings and a menu, returning the Menu."""
+    store.document('config/app').set({'square_id': 'loadtest'})
+    menu = model.SnapshotMenu(model.DEFAULT_LOCATION) or agent.menu()
+    location = model.LocationRef(store, model.DEFAULT_LOCATION)
+    for dish in menu.dishes:
+        ref = location.collection('dishes').document(dish.name)
+        ref.set({'price': dish.price})
+        for ingredient in dish.ingredients:
+            ref.collection('ingredients').document(ingredient.name).set(
+                ingredient.as_dict())
+    model.MenuRef(store, model.DEFAULT_LOCATION).set(menu.as_dict())
+    return menu
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class Level:
+    """The results of running at one concurrency level."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.latencies = collections.defaultdict(list)
+        self.missed = collections.Counter()
+        self.busy = collections.Counter()
+        self.errors = collections.Counter()
+        self.conversations = 0
+        self.abandoned = 0
+        self.seconds = 0
+        self._lock = threading.Lock()
+
+    def record(self, intent, seconds, deadline):
+        with self._lock:
+            self.latencies[intent].append(seconds)
+            if seconds > deadline:
+                self.missed[intent] += 1
+
+    @property
+    def turns(self):
+        return sum(len(x) for x in self.latencies.values())
+
+    def problems(self, miss_threshold):
+        """Returns what went wrong at this level, if anything, as phrases."""
+        problems = []
+        missed = sum(self.missed.values())
+        if missed > miss_threshold * self.turns:
+            problems.append('%d turns over the deadline' % missed)
+        errors = sum(self.errors.values())
+        if errors:
+            problems.append('%d failed turns' % errors)
+        if self.abandoned:
+            problems.append('%d abandoned conversations' % self.abandoned)
+        return problems
+
+    def report(self, deadline):
+        turns = self.turns
+        missed = sum(self.missed.values())
+        print('Concurrency %d: %.1f turns/s, %.1f conversations/s, '
+              '%d abandoned, %d failed turns, %d (%.1f%%) turns over %.1fs' %
+              (self.concurrency, turns / self.seconds,
+               self.conversations / self.seconds, self.abandoned,
+               sum(self.errors.values()), missed, 100 * missed / max(turns, 1),
+               deadline))
+        print('  %-10s %7s %7s %7s %9s %9s %9s' % (
+            'intent', 'turns', 'busy', 'errors', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+        # Intents which only failed have no latencies, but still have a row.
+        intents = set(self.latencies) | set(self.errors) | set(self.busy)
+        for intent in sorted(intents):
+            samples = sorted(self.latencies[intent])
+            if samples:
+                latencies = '%9.1f %9.1f %9.1f' % (
+                    percentile(samples, 0.5) * 1000,
+                    percentile(samples, 0.95) * 1000,
+                    percentile(samples, 0.99) * 1000)
+            else:
+                latencies = '%9s %9s %9s' % ('-', '-', '-')
+            print('  %-10s %7d %7d %7d %s' % (
+                intent, len(samples), self.busy[intent], self.errors[intent],
+                latencies))
+
+
+def run_level(main, agent, menu, args, concurrency):
+    level = Level(concurrency)
+    stop_at = time.monotonic() + args.duration
+
+    def worker(n):
+        rng = random.Random('%s-%d-%d' % (args.seed, concurrency, n))
+        while time.monotonic() < stop_at:
+            conversation = Conversation(agent, menu, rng)
+            items = max(1, round(fake_firestore.exponential(rng, args.items)))
+            if not converse(conversation, rng, items):
+                with level._lock:
+                    level.abandoned += 1
+                continue
+            with level._lock:
+                level.conversations += 1
+
+    def converse(conversation, rng, items):
+        """Runs conversation, returning whether it was completed."""
+        for intent, text, parameters, arguments in conversation.turns(items):
+            for _ in range(args.retries + 1):
+                time.sleep(fake_firestore.exponential(rng, args.think_time))
+                try:
+                    seconds, busy = conversation.turn(
+                        main, intent, text, parameters, arguments)
+                except Exception:
+                    logging.exception('%s turn failed', intent)
+                    with level._lock:
+                        level.errors[intent] += 1
+                    return False
+                level.record(intent, seconds, args.deadline)
+                if not busy:
+                    break
+                # Like a user asked to try again, wait a moment first.
+                with level._lock:
+                    level.busy[intent] += 1
+                time.sleep(1)
+            else:
+                return False
+        return True
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(concurrency)]
+    begin = time.perf_counter()
+    # The webhook prints each intent; keep that out of the report.
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    level.seconds = time.perf_counter() - begin
+    return level
+
+
+def loadtest(args):
+    store = fake_firestore.Client()
+    # The webhook creates its client on import.
+    firestore.Client = lambda *args, **kwargs: store
+    import main
+
+    agent = Agent()
+    menu = seed(store, agent)
+    model.CachedMenu(store)
+    latencies = random.Random('%s/latency' % args.seed)
+    store.latency = lambda: fake_firestore.exponential(latencies, args.latency)
+
+    first_failed = None
+    for concurrency in args.concurrency:
+        level = run_level(main, agent, menu, args, concurrency)
+        level.report(args.deadline)
+        problems = level.problems(args.miss_threshold)
+        if first_failed is None and problems:
+            first_failed = concurrency, problems
+    if first_failed is None:
+        print('No deadlines missed, turns failed or conversations abandoned '
+              'up to concurrency %d' % max(args.concurrency))
+    else:
+        print('First problems at concurrency %d: %s' % (
+            first_failed[0], ', '.join(first_failed[1])))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32,64',
+                        type=lambda x: [int(n) for n in x.split(',')],
+                        help='Comma-separated concurrent conversations.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds to run each concurrency level for.')
+    parser.add_argument('--items', type=float, default=2,
+                        help='Mean number of items added per conversation.')
+    parser.add_argument('--think-time', type=float, default=1,
+                        help='Mean seconds before each turn.')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='How often to retry a turn turned away as '
+                             'busy before abandoning the conversation.')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Mean seconds per Firestore RPC.')
+    parser.add_argument('--deadline', type=float, default=5,
+                        help='Seconds a turn may take.')
+    parser.add_argument('--miss-threshold', type=float, default=0.01,
+                        help='Fraction of turns over the deadline at which '
+                             'a level counts as missing deadlines.')
+    parser.add_argument('--seed', type=int, default=0)
+    loadtest(parser.parse_args())
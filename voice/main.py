@@ -5,26 +5,73 @@ Intents.
 
 To deploy:
   gcloud functions deploy voice --runtime python37 --trigger-http
+
+New instances can be primed by sending a GET to `<function url>/_ah/warmup`,
+e.g. from Cloud Scheduler or right after a deploy.
+
+Each deployment takes orders for one kitchen, set with the LOCATION
+environment variable (`--set-env-vars LOCATION=downtown`).
+
+The conversation carries the order's state (its items and running total) in
+the parameters of the `order` context, along with the document's update_time
+as a version. Handlers use that state rather than reading the order, and
+make their writes conditional on the version, re-reading the order only if
+it changed underneath them.
 """
 
+import copy
 import json
 import math
 import random
 import logging
+import time
 
+import menu_index
+from model import auth
+from model import metrics
 from model import model
-from google.auth.transport import requests
+from model import profiling
+from model import ratelimit
+from model import tracing
+from google.api_core import exceptions
 from google.cloud import firestore
-from google.oauth2 import id_token
+from google.protobuf import timestamp_pb2
 
 db = firestore.Client()
+metrics.instrument_firestore(db)
+tracing.instrument_firestore(db)
 settings = {}
+limiter = ratelimit.default_limiter()
+
+# Intents which read or write Firestore, and so are rate limited.
+LIMITED_INTENTS = {'ls', 'start', 'add', 'checkout', 'receipt'}
+
+# The reply to a turn which is over its rate limit.
+BUSY_MESSAGE = ('Sorry, we\'re a little busy. '
+                'Please try that again in a moment.')
+
+# How many turns the order context survives without being refreshed.
+ORDER_CONTEXT_LIFESPAN = 5
+
+# Attempts at a conditional order write before giving up.
+MAX_ORDER_WRITE_ATTEMPTS = 3
+
+# Location id -> MenuIndex for the current version of its menu.
+_menu_indexes = {}
+
+# How often, in seconds, to write this instance's metrics to the log.
+METRICS_LOG_INTERVAL = 60
 
 
 def ensure_settings():
     if not settings:
-        config = db.document('config/app').get()
-        settings.update(config.to_dict())
+        load_settings()
+
+
+def load_settings():
+    """Reads the app's settings, even if they've been read before."""
+    config = db.document('config/app').get()
+    settings.update(config.to_dict())
 
 
 def response(text: str, **kwargs):
@@ -40,11 +87,8 @@ def extract_user(request_json: dict):
     jwt = request_json.get('user', {}).get('idToken', '')
     if not jwt:
         return {'name': 'Anonymous', 'sub': 0}
-    auth_request = requests.Request()
-    info = id_token.verify_oauth2_token(jwt, auth_request)
-    if info['iss'] not in [
-            'accounts.google.com', 'https://accounts.google.com'
-    ]:
+    info = auth.verify_token(jwt)
+    if info['iss'] not in auth.ISSUERS:
         raise AssertionError('Wrong JWT issuer: %s', info['iss'])
     return info
 
@@ -57,6 +101,84 @@ def get_context(response_json, suffix):
     return {}
 
 
+def get_menu_index(location: str):
+    """Returns the MenuIndex for location, rebuilt if its menu has changed."""
+    menu = model.CachedMenu(db, location)
+    index = _menu_indexes.get(location)
+    if index is None or index.version != menu.version:
+        index = _menu_indexes[location] = menu_index.MenuIndex(menu)
+    return index
+
+
+def order_ref(request_json: dict):
+    """Returns the DocumentReference of the order in this conversation."""
+    params = get_context(request_json, '/order')
+    orders = model.OrdersCollection(
+        db, params.get('location', model.DEFAULT_LOCATION))
+    return orders.document(params.get('orderId'))
+
+
+def order_context(request_json: dict, state: dict):
+    """Returns the output context which carries the order's state."""
+    return {
+        'name': f'{request_json["session"]}/contexts/order',
+        'lifespanCount': ORDER_CONTEXT_LIFESPAN,
+        'parameters': state,
+    }
+
+
+def read_order_state(ref):
+    """Reads the order at ref, returning its state for the order context."""
+    order = model.Order(ref)
+    return {
+        'orderId': order.id,
+        'location': order.location,
+        'version': order.date.ToJsonString(),
+        'items': [x.as_dict() for x in order.items],
+        'total': order.total or 0,
+        'traceId': order.trace_id,
+    }
+
+
+def order_state(request_json: dict):
+    """Returns the order's state, reading it only if the context lacks it."""
+    state = get_context(request_json, '/order')
+    if 'version' not in state:
+        metrics.inc('order_state_reads_total', reason='missing')
+        state = read_order_state(order_ref(request_json))
+    return state
+
+
+def update_order(request_json: dict, update):
+    """Applies update to the order's state and writes the changed fields.
+
+    update(state) modifies state in place, and returns the fields to write.
+    The write only succeeds if the order is still at the state's version;
+    otherwise the order is re-read and update is applied again.
+
+    Returns:
+      {dict} The new state, at the version written.
+    """
+    ref = order_ref(request_json)
+    state = order_state(request_json)
+    for _ in range(MAX_ORDER_WRITE_ATTEMPTS):
+        new_state = copy.deepcopy(state)
+        fields = update(new_state)
+        fields[model.UPDATED_FIELD] = firestore.SERVER_TIMESTAMP
+        version = timestamp_pb2.Timestamp()
+        version.FromJsonString(state['version'])
+        try:
+            result = ref.update(
+                fields, option=db.write_option(last_update_time=version))
+        except exceptions.FailedPrecondition:
+            metrics.inc('order_state_reads_total', reason='conflict')
+            state = read_order_state(ref)
+            continue
+        new_state['version'] = result.update_time.ToJsonString()
+        return new_state
+    raise AssertionError('Order %s kept changing while writing' % ref.path)
+
+
 def payment_data(settings, subtype):
     return {
         '@type': f'type.googleapis.com/google.actions.v2.{subtype}',
@@ -117,7 +239,7 @@ def welcome(request_json: dict):
 
 
 def list_menu(request_json: dict):
-    dishes = [x for x in model.AllDishes(db)]
+    dishes = model.CachedMenu(db).dishes
     human = ['a ' + x.name for x in dishes]
     human[-1] = 'and ' + human[-1]
     concat = ', '.join(human)
@@ -157,41 +279,84 @@ def validate_payment(request_json: dict):
         return response('Sorry, I couldn\'t get transaction information.')
 
     user = extract_user(request_json)
-    _, doc = db.collection('orders').add({'user': user['sub'], 'items': []})
+    # Write every field `background` fills in, so it has nothing to change.
+    update_time, doc = model.OrdersCollection(db).add({
+        'user': user['sub'],
+        'done': False,
+        'items': [],
+        'token': {},
+        'totalPrice': 0,
+        'created': firestore.SERVER_TIMESTAMP,
+        model.UPDATED_FIELD: firestore.SERVER_TIMESTAMP,
+        tracing.TRACE_FIELD: tracing.current_trace_id(),
+    })
 
     logging.info(doc.__dict__)
 
-    order_context = {
-        'name': f'{request_json["session"]}/contexts/order',
-        'lifespanCount': 5,
-        'parameters': {
-            'orderId': doc.id,
-        }
+    state = {
+        'orderId': doc.id,
+        'location': model.DEFAULT_LOCATION,
+        'version': update_time.ToJsonString(),
+        'items': [],
+        'total': 0,
+        'traceId': tracing.current_trace_id(),
     }
     return response(
-        'Okay, let\'s start your order', outputContexts=[order_context])
+        'Okay, let\'s start your order',
+        outputContexts=[order_context(request_json, state)])
 
 
 def add_item(request_json: dict):
-    dish = request_json.get('queryResult', {}).get('parameters', {}).get(
-        'Dish', '')
+    parameters = request_json.get('queryResult', {}).get('parameters', {})
+    dish = parameters.get('Dish', '')
     if not dish:
         return response('I\'m sorry, I don\'t understand what you wanted')
-    order_id = get_context(request_json, '/order').get('orderId')
-    order = model.Order(db.document(f'orders/{order_id}'))
-    order.items.append(model.OrderItem(dish))
-    order.set()
-    return response(f'Great, added a {dish} to your order')
+    location = get_context(request_json, '/order').get(
+        'location', model.DEFAULT_LOCATION)
+    index = get_menu_index(location)
+    name = index.match_dish(dish)
+    if not name:
+        return response(f'Sorry, we don\'t have {dish} on the menu.')
+
+    # Ingredients come in parameters named for their entities, e.g. Greens or
+    # Proteins.
+    choices = {}
+    for entity in sorted(index.entities):
+        values = parameters.get(entity)
+        if not values:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        for value in values:
+            match = index.match_choice(name, value)
+            if not match:
+                return response(f'Sorry, the {name} doesn\'t come with {value}.')
+            category, choice = match
+            choices.setdefault(category, []).append(choice)
+    category = index.over_limit(name, choices)
+    if category:
+        return response(f'Sorry, that\'s too many {category} for a {name}.')
+
+    item = model.OrderItem(name, **choices)
+    price = item.get_price(model.CachedMenu(db, location).prices)
+
+    def add(state):
+        state['items'].append(item.as_dict())
+        state['total'] += price
+        return {'items': state['items'], 'totalPrice': state['total']}
+
+    state = update_order(request_json, add)
+    return response(f'Great, added a {name} to your order',
+                    outputContexts=[order_context(request_json, state)])
 
 
 def checkout(request_json: dict):
-    order_id = get_context(request_json, '/order').get('orderId')
-    order = model.Order(db.document(f'orders/{order_id}'))
-    prices = model.PriceSheet(model.AllDishes(db))
+    state = order_state(request_json)
+    prices = model.CachedMenu(db, state['location']).prices
     total = 0
     lineItems = []
     id = 0
-    for item in order.items:
+    for item in (model.OrderItem(**x) for x in state['items']):
         id += 1
         price = item.get_price(prices)
         total += price
@@ -205,7 +370,7 @@ def checkout(request_json: dict):
 
     data = payment_data(settings, 'TransactionDecisionValueSpec')
     data['proposedOrder'] = {
-        'id': order_id,
+        'id': state['orderId'],
         'cart': {
             'merchant': {
                 'id': 'serverless-next-demo',
@@ -231,7 +396,8 @@ def checkout(request_json: dict):
                     }]
                 }
             }
-        }
+        },
+        'outputContexts': [order_context(request_json, state)],
     }
     logging.info(f'Returning {result}')
     return result
@@ -249,11 +415,12 @@ def receipt(request_json: dict):
     if not instrument:
         return response(
             'Sorry, I couldn\'t read your transaction information.')
-    order_id = get_context(request_json, '/order').get('orderId')
-    order = model.Order(db.document(f'orders/{order_id}'))
     logging.info(f'Storing token from {instrument}')
-    order.token = instrument.get('instrumentToken')
-    order.set()
+
+    def pay(state):
+        return {'token': instrument.get('instrumentToken')}
+
+    update_order(request_json, pay)
     return response(
         'Thanks for your order. We\'ll get started on it right away!')
 
@@ -282,13 +449,72 @@ def build_response(request_json: dict):
     intent = request_json['queryResult']['intent']['displayName']
     handler = HANDLERS[intent]
     print("Intent is %s" % intent)
-    return handler(request_json)
+    # Join the order's trace, if this conversation has started one.
+    trace_id = get_context(request_json, '/order').get('traceId')
+    with tracing.span(f'intent {intent}', trace_id, intent=intent):
+        return _run_handler(request_json, intent, handler)
+
+
+def _run_handler(request_json: dict, intent: str, handler):
+    start = time.perf_counter()
+    failed = True
+    try:
+        if intent in LIMITED_INTENTS:
+            # Each conversation is one user, so limit by session.
+            with limiter.admit(request_json.get('session', ''), intent):
+                result = handler(request_json)
+        else:
+            result = handler(request_json)
+        failed = False
+        return result
+    except ratelimit.Throttled:
+        failed = False
+        return response(BUSY_MESSAGE)
+    finally:
+        metrics.record_request(time.perf_counter() - start, failed=failed,
+                               intent=intent)
+
+
+def warmup():
+    """Prime this instance's settings, menu, Firestore channel and certs.
+
+    Returns the time taken by each step, in milliseconds.
+    """
+    # A cheap listing opens the Firestore channel, so that the settings step
+    # times only their read, which is made even if they're already loaded.
+    steps = [
+        ('firestore', lambda: model.Locations(db)),
+        ('settings', load_settings),
+        ('menu', lambda: model.CachedMenu(db)),
+        ('certs', auth.fetch_certs),
+    ]
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    logging.info('Warmup timings (ms): %s', timings)
+    return timings
 
 
 def voice(request):
+    if request.path.endswith('/_ah/warmup'):
+        return json.dumps(warmup())
     data = request.get_json()
     logging.info("Got message: %s", json.dumps(data, sort_keys=True))
-    response = build_response(data)
+    if profiling.should_profile(request.headers.get(profiling.PROFILE_HEADER)):
+        profiler = profiling.start()
+        start = time.perf_counter()
+        try:
+            response = build_response(data)
+        finally:
+            intent = data.get('queryResult', {}).get('intent', {}).get(
+                'displayName', 'unknown')
+            profiling.finish(profiler, intent, time.perf_counter() - start)
+    else:
+        response = build_response(data)
+    if metrics.due(METRICS_LOG_INTERVAL):
+        logging.info(json.dumps({'metrics': metrics.snapshot()}))
     return json.dumps(response)
 
 
@@ -297,6 +523,7 @@ if __name__ == "__main__":
     app = flask.Flask(__name__)
 
     @app.route("/", methods=["POST"])
+    @app.route("/_ah/warmup")
     def default():
         return voice(flask.request)
 
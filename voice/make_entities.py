@@ -1,12 +1,17 @@
 """Auto-generate Dialogflow entities from Firestore resources.
 
 Usage:
-  python make_entities.py
+  LOCATION=<location id> python make_entities.py
 
 Note: you must have already configured your Google Cloud credentials.
 This only generates the JSON files which need to be imported into Dialogflow.
 To import, zip the entire "dialogflow" folder and upload using the "import
 from zip" option in the Dialogflow console.
+
+It also writes the location's compiled menu to model/menus/<location>.json
+in the voice, web and background directories, so that each deployment can
+start serving the menu without reading it from Firestore. Redeploy them to
+ship the new snapshot.
 """
 
 import json
@@ -16,29 +21,51 @@ import sys
 import uuid
 from google.cloud import firestore
 
+import menu_index
+from model import model
+
 db = firestore.Client()
 
+# Entities are generated from the menu of a single location.
+LOCATION = os.getenv('LOCATION', 'default')
+
 BASE_ENTITY = {
     'isOverridable': True,
     'isEnum': False,
     'automatedExpansion': True
 }
 
+# The deployments which bundle a snapshot of the menu.
+SNAPSHOT_BUNDLES = ('voice', 'web', 'background')
+
 DISH_UUID = '4f9af8e1-9c3d-42bc-8c59-41afde4a15b5'
 INGREDIENTS_UUID = '412b8e29-ae93-4073-b8a1-c70d6eae5113'
 
 
+def dishes_collection(database):
+    return database.collection('locations', LOCATION, 'dishes')
+
+
 def fetch_dishes(database):
-    for dish in database.collection('dishes').stream():
+    for dish in dishes_collection(database).stream():
         yield dish
 
 
 def fetch_entities(database):
-    for dish in database.collection('dishes').list_documents():
+    for dish in dishes_collection(database).list_documents():
         for ingredient in dish.collection('ingredients').stream():
             yield ingredient
 
 
+def write_menu_snapshots(database):
+    menu = model.Menu(model.AllDishes(database, LOCATION))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for bundle in SNAPSHOT_BUNDLES:
+        directory = os.path.join(root, bundle, 'model', 'menus')
+        model.WriteSnapshot(menu, LOCATION, directory)
+    return menu
+
+
 def write_items(uuid, name, item_list):
     name = name.capitalize()
     entity_path = os.path.join('dialogflow', 'entities', name + '.json')
@@ -54,7 +81,7 @@ def write_items(uuid, name, item_list):
 
 
 def write_entity(name, options_list, entity):
-    name = name.capitalize()
+    name = menu_index.entity_name(name)
     entity_path = os.path.join('dialogflow', 'entities', name + '.json')
     en_path = os.path.join('dialogflow', 'entities', name + '_entries_en.json')
 
@@ -93,3 +120,6 @@ if __name__ == '__main__':
     write_items(INGREDIENTS_UUID, 'Ingredients', all_ingredients)
 
     print('Found %d entities!' % i)
+
+    menu = write_menu_snapshots(db)
+    print('Wrote menu snapshot version %s for %s' % (menu.version, LOCATION))
@@ -0,0 +1,170 @@
+"""In-memory index for matching spoken dish and ingredient names to the menu.
+
+Dialogflow hands us whatever text it matched for an entity, which may be a
+synonym, a plural, a prefix ("grain" for "grain bowl") or a near miss. The
+index maps these to the canonical names used in Firestore (and hence in the
+price sheet) without any RPCs, by trying in turn:
+
+  1. an exact match on the normalized name or one of its synonyms,
+  2. a unique prefix match, using bisection over the sorted terms,
+  3. the unique closest term within a small edit distance.
+
+The synonyms are only used here: the entities uploaded to Dialogflow list
+just the canonical names, which it expands itself.
+"""
+
+import bisect
+import re
+
+# Leading words which never distinguish one menu item from another.
+_FILLER = re.compile(r'^(?:(?:a|an|the|some|one|extra)\s+)+')
+
+
+def normalize(text: str):
+    text = re.sub(r'[^a-z0-9 ]+', ' ', text.lower())
+    return _FILLER.sub('', ' '.join(text.split()))
+
+
+# (plural ending, singular ending) of regular plurals, most specific first.
+_PLURAL_ENDINGS = (
+    ('ies', 'y'),
+    ('oes', 'o'),
+    ('ches', 'ch'),
+    ('shes', 'sh'),
+    ('xes', 'x'),
+    ('s', ''),
+)
+
+# Endings of words which aren't plurals, e.g. hummus, couscous, swiss.
+_NOT_PLURAL = ('ss', 'us', 'is')
+
+
+def inflect(word: str):
+    """Returns the singular of a plural word or the plural of a singular
+    one, or None if it's unclear which word is."""
+    if word.endswith('s'):
+        if len(word) < 4 or word.endswith(_NOT_PLURAL):
+            return None
+        for plural, singular in _PLURAL_ENDINGS:
+            if word.endswith(plural):
+                return word[:-len(plural)] + singular
+    if word.endswith(('x', 'z', 'ch', 'sh')):
+        return word + 'es'
+    if re.search(r'[^aeiou]y$', word):
+        return word[:-1] + 'ies'
+    return word + 's'
+
+
+def synonyms(name: str):
+    """Returns the alternate names we accept for a menu item: its
+    normalized name, and that with its last word inflected if sensible."""
+    name = normalize(name)
+    result = [name]
+    *words, last = name.split(' ')
+    other = inflect(last) if last else None
+    if other:
+        result.append(' '.join(words + [other]))
+    return result
+
+
+def entity_name(category: str):
+    """The name of the Dialogflow entity for a category of ingredients, as
+    written by make_entities.py, and of the add intent's parameter for it."""
+    return category.capitalize()
+
+
+def edit_distance(a: str, b: str, limit: int):
+    """Levenshtein distance between a and b, or limit + 1 if it's larger."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class _Terms:
+    """Maps normalized terms to values, with prefix and fuzzy fallbacks."""
+
+    def __init__(self):
+        self._values = {}
+        self._sorted = []
+
+    def add(self, name, value):
+        for term in synonyms(name):
+            self._values.setdefault(term, value)
+
+    def freeze(self):
+        self._sorted = sorted(self._values)
+
+    def lookup(self, text: str):
+        term = normalize(text)
+        if not term:
+            return None
+        if term in self._values:
+            return self._values[term]
+
+        start = bisect.bisect_left(self._sorted, term)
+        end = bisect.bisect_left(self._sorted, term + '\uffff')
+        matches = {self._values[x] for x in self._sorted[start:end]}
+        if len(matches) == 1:
+            return matches.pop()
+
+        limit = max(1, len(term) // 4)
+        best, best_distance = set(), limit + 1
+        for candidate, value in self._values.items():
+            distance = edit_distance(term, candidate, limit)
+            if distance < best_distance:
+                best, best_distance = {value}, distance
+            elif distance == best_distance:
+                best.add(value)
+        if best_distance <= limit and len(best) == 1:
+            return best.pop()
+        return None
+
+
+class MenuIndex:
+    """Canonical dish and ingredient names for one version of a Menu."""
+
+    def __init__(self, menu):
+        self.version = menu.version
+        self._dishes = _Terms()
+        # dish -> _Terms mapping choices to (category, choice)
+        self._choices = {}
+        # dish -> {category: max number of choices, or 0 for no limit}
+        self._limits = {}
+        # The names of the add intent's ingredient parameters.
+        self.entities = set()
+        for dish in menu.dishes:
+            self._dishes.add(dish.name, dish.name)
+            choices = self._choices[dish.name] = _Terms()
+            self._limits[dish.name] = {}
+            for category in dish.ingredients:
+                self._limits[dish.name][category.name] = category.max_items
+                self.entities.add(entity_name(category.name))
+                for choice in category.choices or []:
+                    choices.add(choice, (category.name, choice))
+            choices.freeze()
+        self._dishes.freeze()
+
+    def match_dish(self, text: str):
+        """Returns the canonical name of the dish text refers to, or None."""
+        return self._dishes.lookup(text)
+
+    def match_choice(self, dish: str, text: str):
+        """Returns (category, choice) for an ingredient of dish, or None."""
+        return self._choices[dish].lookup(text)
+
+    def over_limit(self, dish: str, choices: dict):
+        """Returns a category with more choices than dish allows, or None."""
+        for category, selected in choices.items():
+            limit = self._limits[dish].get(category, 0)
+            if limit and len(selected) > limit:
+                return category
+        return None
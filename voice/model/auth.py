@@ -0,0 +1,77 @@
+"""Verification of Google-issued ID tokens with per-instance cert caching.
+
+`google.oauth2.id_token.verify_oauth2_token` downloads Google's signing certs
+on every call. The certs are rotated rarely and served with a Cache-Control
+max-age, so we keep a copy per instance and only refetch once it expires.
+"""
+
+import json
+import re
+import threading
+import time
+
+from google.auth import exceptions
+from google.auth import jwt
+from google.auth.transport import requests
+
+from model import metrics
+
+CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
+# Used if the cert response doesn't carry a usable max-age.
+DEFAULT_CERTS_MAX_AGE = 3600
+
+# Tokens signed by a key we don't know force a refetch of the certs at most
+# this often, in seconds, so bogus tokens can't queue every verification
+# behind fetches. Tokens with unknown keys are rejected in between.
+MIN_FORCED_REFETCH_INTERVAL = 60
+
+# Shared so the HTTP session (and its TLS connection) is reused.
+_request = requests.Request()
+_lock = threading.Lock()
+_certs = {'expires': 0, 'fetched': 0, 'certs': None}
+
+
+def _max_age(headers):
+    match = re.search(r'max-age=(\d+)', headers.get('cache-control', ''))
+    if match:
+        return int(match.group(1))
+    return DEFAULT_CERTS_MAX_AGE
+
+
+def fetch_certs(force=False):
+    """Returns Google's current signing certs, fetching them if needed.
+
+    With force, they're fetched even if unexpired, unless they were fetched
+    in the last MIN_FORCED_REFETCH_INTERVAL seconds.
+    """
+    with _lock:
+        now = time.time()
+        hit = _certs['certs'] and now < _certs['expires']
+        if force and now < _certs['fetched'] + MIN_FORCED_REFETCH_INTERVAL:
+            force = False
+        metrics.cache_lookup('certs', hit and not force)
+        if hit and not force:
+            return _certs['certs']
+        response = _request(CERTS_URL, method='GET')
+        if response.status != 200:
+            raise exceptions.TransportError(
+                'Could not fetch certificates at %s' % CERTS_URL)
+        _certs['certs'] = json.loads(response.data.decode('utf-8'))
+        _certs['fetched'] = time.time()
+        _certs['expires'] = _certs['fetched'] + _max_age(response.headers)
+        return _certs['certs']
+
+
+def verify_token(token, audience=None):
+    """Verifies an ID token, returning its claims.
+
+    This is a drop-in replacement for `id_token.verify_oauth2_token`; as with
+    that function, callers still need to check the `iss` claim.
+    """
+    certs = fetch_certs()
+    if jwt.decode_header(token).get('kid') not in certs:
+        # Signed by a key rotated in since our last fetch.
+        certs = fetch_certs(force=True)
+    return jwt.decode(token, certs=certs, audience=audience)
@@ -0,0 +1,192 @@
+"""In-process counters and latency histograms.
+
+Metrics are kept in memory per instance, and can be rendered in the Prometheus
+text exposition format with `render()` or as a plain dict with `snapshot()`.
+Updates take a single lock and a dict lookup, so they are cheap enough to leave
+on in production.
+
+Metric names used across the platform:
+  requests_total{route|intent}           Requests handled.
+  request_errors_total{route|intent}     Requests which failed.
+  request_latency_seconds{route|intent}  Request latency histogram.
+  firestore_rpcs_total{method}           Firestore RPCs issued.
+  cache_requests_total{cache,result}     Cache lookups, by hit or miss.
+  singleflight_calls_total{group,result} Coalesced calls, by whether they
+                                         ran (leader), waited for one in
+                                         flight (shared) or reused a recent
+                                         result (cached).
+"""
+
+import collections
+import functools
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Firestore RPCs, as named on the generated API client.
+FIRESTORE_METHODS = (
+    'get_document', 'list_documents', 'create_document', 'update_document',
+    'delete_document', 'batch_get_documents', 'begin_transaction', 'commit',
+    'rollback', 'run_query', 'list_collection_ids',
+)
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(float)
+# name -> labels -> [count per bucket..., +Inf count, sum]
+_histograms = collections.defaultdict(dict)
+_last_dump = [time.monotonic()]
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds value to the counter name{labels}."""
+    key = (name, _key(labels))
+    with _lock:
+        _counters[key] += value
+
+
+def observe(name, value, **labels):
+    """Records value in the histogram name{labels}."""
+    key = _key(labels)
+    with _lock:
+        buckets = _histograms[name].get(key)
+        if buckets is None:
+            buckets = _histograms[name][key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+                break
+        else:
+            buckets[-2] += 1
+        buckets[-1] += value
+
+
+def record_request(seconds, failed=False, **labels):
+    """Records one request's latency and outcome."""
+    inc('requests_total', **labels)
+    if failed:
+        inc('request_errors_total', **labels)
+    observe('request_latency_seconds', seconds, **labels)
+
+
+def cache_lookup(cache, hit):
+    inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def _count_rpc(method, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        inc('firestore_rpcs_total', method=method)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def instrument_firestore(db):
+    """Counts every RPC made by the Firestore client db."""
+    api = getattr(db, '_firestore_api', None)
+    if api is None:
+        return
+    for method in FIRESTORE_METHODS:
+        if hasattr(api, method):
+            setattr(api, method, _count_rpc(method, getattr(api, method)))
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in pairs)
+
+
+def _format_value(value):
+    """Formats a sample value without losing precision, as %g would past
+    six digits."""
+    return repr(float(value))
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        by_name = collections.defaultdict(list)
+        for (name, labels), value in _counters.items():
+            by_name[name].append((labels, value))
+        for name in sorted(by_name):
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in sorted(by_name[name]):
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          _format_value(value)))
+        for name in sorted(_histograms):
+            lines.append('# TYPE %s histogram' % name)
+            for labels, buckets in sorted(_histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, le=bound), cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels), _format_value(buckets[-1])))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def _percentile(buckets, fraction):
+    """Estimates a percentile as the upper bound of its bucket."""
+    target = fraction * sum(buckets[:-1])
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+        seen += count
+        if seen >= target:
+            return bound
+    return '+Inf'
+
+
+def snapshot():
+    """Returns a JSON-friendly summary of all metrics."""
+    with _lock:
+        counters = collections.defaultdict(dict)
+        for (name, labels), value in _counters.items():
+            counters[name][_format_labels(labels) or 'total'] = value
+        latencies = {}
+        for name, series in _histograms.items():
+            for labels, buckets in series.items():
+                count = sum(buckets[:-1])
+                latencies[_format_labels(labels) or name] = {
+                    'count': count,
+                    'mean': buckets[-1] / count if count else 0,
+                    'p50': _percentile(buckets, 0.5),
+                    'p95': _percentile(buckets, 0.95),
+                    'p99': _percentile(buckets, 0.99),
+                }
+        lookups = collections.defaultdict(collections.Counter)
+        for (name, labels), value in _counters.items():
+            if name == 'cache_requests_total':
+                labels = dict(labels)
+                lookups[labels['cache']][labels['result']] += value
+        hit_ratios = {
+            cache: counts['hit'] / sum(counts.values())
+            for cache, counts in lookups.items()
+        }
+    return {
+        'counters': dict(counters),
+        'latency_seconds': latencies,
+        'cache_hit_ratio': hit_ratios,
+    }
+
+
+def due(interval):
+    """Returns True at most once per interval seconds, for periodic dumps."""
+    now = time.monotonic()
+    with _lock:
+        if now - _last_dump[0] < interval:
+            return False
+        _last_dump[0] = now
+        return True
@@ -0,0 +1,54 @@
+"""Opt-in profiling of individual requests.
+
+A request is profiled when it carries the `X-Profile` header set to the value
+of the PROFILE_TOKEN environment variable, or when it is picked at random at
+PROFILE_SAMPLE_RATE (a fraction between 0 and 1; the default of 0 disables
+sampling). Profiles are written in pstats format to PROFILE_DIR, named after
+the route or intent and how long the request took, e.g.
+`chef-153ms-1555555555123.pstats`. View them with `python -m pstats` or
+snakeviz, or convert them for flamegraph tools with flameprof.
+
+When neither trigger is configured, the cost per request is one comparison.
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import time
+
+PROFILE_HEADER = 'X-Profile'
+
+_token = os.getenv('PROFILE_TOKEN', '')
+_sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+_profile_dir = os.getenv('PROFILE_DIR', '/tmp/profiles')
+
+
+def should_profile(header_value=None):
+    """Returns True if a request with the given X-Profile header is profiled."""
+    # compare_digest only takes ASCII strs, so compare the encoded bytes.
+    if _token and header_value and hmac.compare_digest(
+            header_value.encode(), _token.encode()):
+        return True
+    return _sample_rate > 0 and random.random() < _sample_rate
+
+
+def start():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish(profiler, name, seconds):
+    """Stops profiler and writes its stats, returning the file path."""
+    profiler.disable()
+    os.makedirs(_profile_dir, exist_ok=True)
+    filename = '%s-%dms-%d.pstats' % (
+        re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_') or 'root',
+        seconds * 1000, time.time() * 1000)
+    path = os.path.join(_profile_dir, filename)
+    profiler.dump_stats(path)
+    logging.info('Wrote profile of %s to %s', name, path)
+    return path
@@ -0,0 +1,146 @@
+"""Admission control for handlers which hit Firestore.
+
+Two limits apply to each admitted request:
+  * a token bucket per (user, route or intent), refilled at `rate` requests
+    per second up to `burst`, and
+  * a cap on how many limited requests may run at once on this instance.
+
+Requests over either limit fail fast with `Throttled`, rather than queueing
+and holding Firestore capacity for everyone else.
+
+Buckets are kept by a backend. `LocalBackend` keeps them in this instance's
+memory. `RedisBackend` shares them between instances (e.g. via Memorystore)
+and is used if RATE_LIMIT_REDIS_URL is set; it needs the optional `redis`
+package. To run its script locally without a Redis server, set
+RATE_LIMIT_REDIS_URL=fakeredis:// and install `fakeredis[lua]`, which runs
+it against an in-process Redis.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+from model import metrics
+
+# Defaults, overridable through the environment.
+RATE = float(os.getenv('RATE_LIMIT_RATE', '2'))
+BURST = float(os.getenv('RATE_LIMIT_BURST', '10'))
+MAX_CONCURRENT = int(os.getenv('RATE_LIMIT_MAX_CONCURRENT', '16'))
+
+# A RATE_LIMIT_REDIS_URL which selects an in-process stand-in for Redis.
+FAKE_REDIS_URL = 'fakeredis://'
+
+
+class Throttled(Exception):
+    """Raised when a request is over its limit."""
+
+    def __init__(self, retry_after):
+        super().__init__('Rate limited, retry after %.1fs' % retry_after)
+        self.retry_after = retry_after
+
+
+class LocalBackend:
+    """Token buckets in this instance's memory."""
+
+    # Once this many buckets exist, full (idle) ones are dropped.
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst, now):
+        """Takes a token from key's bucket.
+
+        Returns 0 on success, or else how many seconds until one is available.
+        """
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune(rate, burst, now)
+            return wait
+
+    def _prune(self, rate, burst, now):
+        self._buckets = {
+            k: (tokens, last)
+            for k, (tokens, last) in self._buckets.items()
+            if tokens + (now - last) * rate < burst
+        }
+
+
+class RedisBackend:
+    """Token buckets shared between instances through Redis."""
+
+    _SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'last', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, url):
+        if url.startswith(FAKE_REDIS_URL):
+            import fakeredis  # Optional; only for local development.
+            client = fakeredis.FakeRedis()
+        else:
+            import redis  # Optional; only needed for a shared backend.
+            client = redis.Redis.from_url(url)
+        self._take = client.register_script(self._SCRIPT)
+
+    def take(self, key, rate, burst, now):
+        return float(self._take(keys=['ratelimit:' + key],
+                                args=[rate, burst, now]))
+
+
+class Limiter:
+    def __init__(self, backend, rate=RATE, burst=BURST,
+                 max_concurrent=MAX_CONCURRENT):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    @contextlib.contextmanager
+    def admit(self, user, route):
+        """Runs the body if user is within their limit on route.
+
+        Raises:
+          Throttled -- if the user's bucket is empty, or too many requests
+                       are already running on this instance.
+        """
+        wait = self.backend.take('%s:%s' % (route, user), self.rate,
+                                 self.burst, time.time())
+        if wait:
+            metrics.inc('throttled_total', route=route, reason='rate')
+            raise Throttled(wait)
+        if not self._slots.acquire(blocking=False):
+            metrics.inc('throttled_total', route=route, reason='concurrency')
+            raise Throttled(1)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+def default_limiter():
+    """Returns a Limiter on the backend configured by the environment."""
+    url = os.getenv('RATE_LIMIT_REDIS_URL')
+    return Limiter(RedisBackend(url) if url else LocalBackend())
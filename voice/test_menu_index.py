@@ -0,0 +1,122 @@
+"""Tests of matching spoken names to the menu in menu_index.py.
+
+  python -m unittest test_menu_index
+"""
+
+import types
+import unittest
+
+import menu_index
+
+
+def category(name, choices, max_items=0):
+    return types.SimpleNamespace(name=name, choices=choices,
+                                 max_items=max_items)
+
+
+def dish(name, *ingredients):
+    return types.SimpleNamespace(name=name, ingredients=list(ingredients))
+
+
+MENU = types.SimpleNamespace(version='v1', dishes=[
+    dish('grain bowl',
+         category('base', ['rice', 'quinoa'], max_items=1),
+         category('toppings', ['tomatoes', 'strawberries', 'corn', 'cord'],
+                  max_items=2)),
+    dish('salad', category('greens', ['kale', 'romaine'])),
+    dish('soup'),
+    dish('hummus'),
+])
+
+
+class InflectTest(unittest.TestCase):
+    def test_plurals_become_singular(self):
+        self.assertEqual(menu_index.inflect('tomatoes'), 'tomato')
+        self.assertEqual(menu_index.inflect('strawberries'), 'strawberry')
+        self.assertEqual(menu_index.inflect('peaches'), 'peach')
+        self.assertEqual(menu_index.inflect('radishes'), 'radish')
+        self.assertEqual(menu_index.inflect('carrots'), 'carrot')
+        self.assertEqual(menu_index.inflect('peas'), 'pea')
+
+    def test_singulars_become_plural(self):
+        self.assertEqual(menu_index.inflect('berry'), 'berries')
+        self.assertEqual(menu_index.inflect('radish'), 'radishes')
+        self.assertEqual(menu_index.inflect('box'), 'boxes')
+        self.assertEqual(menu_index.inflect('avocado'), 'avocados')
+        self.assertEqual(menu_index.inflect('turkey'), 'turkeys')
+
+    def test_words_which_only_look_plural_are_left_alone(self):
+        for word in ('hummus', 'couscous', 'swiss', 'tennis', 'gas'):
+            self.assertIsNone(menu_index.inflect(word), word)
+
+    def test_synonyms_inflect_only_the_last_word(self):
+        self.assertEqual(menu_index.synonyms('Grain Bowl'),
+                         ['grain bowl', 'grain bowls'])
+        self.assertEqual(menu_index.synonyms('swiss cheese'),
+                         ['swiss cheese', 'swiss cheeses'])
+        self.assertEqual(menu_index.synonyms('hummus'), ['hummus'])
+        self.assertEqual(menu_index.synonyms('!!'), [''])
+
+
+class MenuIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = menu_index.MenuIndex(MENU)
+
+    def test_exact_and_inflected_names(self):
+        self.assertEqual(self.index.match_dish('grain bowls'), 'grain bowl')
+        self.assertEqual(self.index.match_dish('the Soup!'), 'soup')
+        self.assertEqual(self.index.match_dish('hummus'), 'hummus')
+        self.assertIsNone(self.index.match_dish('pizza'))
+        self.assertEqual(self.index.match_choice('grain bowl', 'tomato'),
+                         ('toppings', 'tomatoes'))
+        self.assertEqual(
+            self.index.match_choice('grain bowl', 'extra strawberry'),
+            ('toppings', 'strawberries'))
+
+    def test_unique_prefix_matches(self):
+        self.assertEqual(self.index.match_dish('grain'), 'grain bowl')
+        self.assertEqual(self.index.match_dish('sal'), 'salad')
+        self.assertEqual(self.index.match_choice('grain bowl', 'quin'),
+                         ('base', 'quinoa'))
+
+    def test_ambiguous_prefix_does_not_match(self):
+        self.assertIsNone(self.index.match_dish('s'))
+        self.assertIsNone(self.index.match_choice('grain bowl', 'cor'))
+
+    def test_close_misspellings_match_within_the_limit(self):
+        self.assertEqual(self.index.match_dish('sallad'), 'salad')
+        self.assertEqual(self.index.match_dish('soop'), 'soup')
+        self.assertEqual(self.index.match_choice('salad', 'kalle'),
+                         ('greens', 'kale'))
+
+    def test_misspellings_past_the_limit_do_not_match(self):
+        # One edit is allowed per four characters.
+        self.assertIsNone(self.index.match_dish('sxxp'))
+        self.assertIsNone(self.index.match_dish('slada'))
+
+    def test_equally_close_names_do_not_match(self):
+        self.assertIsNone(self.index.match_choice('grain bowl', 'cort'))
+
+    def test_choices_are_per_dish(self):
+        self.assertIsNone(self.index.match_choice('salad', 'quinoa'))
+        self.assertIsNone(self.index.match_choice('soup', 'kale'))
+
+    def test_over_limit(self):
+        self.assertIsNone(self.index.over_limit(
+            'grain bowl', {'base': ['rice'], 'toppings': ['corn', 'cord']}))
+        self.assertEqual(self.index.over_limit(
+            'grain bowl', {'base': ['rice', 'quinoa']}), 'base')
+        self.assertEqual(self.index.over_limit(
+            'grain bowl', {'toppings': ['corn', 'cord', 'tomatoes']}),
+            'toppings')
+        # No max means no limit.
+        self.assertIsNone(self.index.over_limit(
+            'salad', {'greens': ['kale', 'romaine']}))
+
+    def test_entities(self):
+        self.assertEqual(self.index.entities,
+                         {'Base', 'Toppings', 'Greens'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,20 +6,54 @@ well as Google Sign In for both.
 
 import flask
 import simplejson
+import datetime
 import logging
 import os
-from google.auth.transport import requests
-from google.oauth2 import id_token
+import time
 from google.cloud import firestore
 
+from model import auth
+from model import metrics
 from model import model
+from model import profiling
+from model import ratelimit
+from model import singleflight
+from model import tracing
 
 # If `entrypoint` is not defined in app.yaml, App Engine will look for an app
 # called `app` in `main.py`.
 app = flask.Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 60
 db = firestore.Client()
+metrics.instrument_firestore(db)
+tracing.instrument_firestore(db)
 settings = {}
+limiter = ratelimit.default_limiter()
+# Orders written this long before a delta sync token was issued are sent
+# again, in case our clock is ahead of Firestore's commit timestamps.
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+# Kitchen screens tend to poll /chef together. Concurrent requests for a
+# location share one query and rendering, which is then reused for
+# CHEF_RESULT_TTL seconds.
+chef_pages = singleflight.Group('chef',
+                                float(os.getenv('CHEF_RESULT_TTL', '2')))
+# Requests check their ?location= against the known locations, which are
+# listed at most once per LOCATIONS_TTL seconds.
+known_locations = singleflight.Group(
+    'locations', float(os.getenv('LOCATIONS_TTL', '60')))
+# The number of proxies in front of the app which append the address they
+# were called from to X-Forwarded-For: App Engine's front end.
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '1'))
+
+
+def client_address(req):
+    """Returns the client's address, as seen by the outermost trusted proxy.
+
+    Entries in X-Forwarded-For before those the trusted proxies appended are
+    whatever the client sent, so they can't be used to identify it.
+    """
+    route = req.access_route
+    return route[max(0, len(route) - TRUSTED_PROXIES)]
 
 
 def read_jwt_token(req):
@@ -30,11 +64,9 @@ def read_jwt_token(req):
         initialize()
     app.logger.info('Checking auth for "%s"' % req.headers['Authorization'])
     jwt = req.headers['Authorization'].split(' ').pop()
-    auth_request = requests.Request()
     app.logger.info('Checking JWT "%s"' % jwt)
-    id_info = id_token.verify_oauth2_token(jwt, auth_request,
-                                           settings['client_id'])
-    if id_info['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
+    id_info = auth.verify_token(jwt, settings['client_id'])
+    if id_info['iss'] not in auth.ISSUERS:
         raise AssertionError(
             'Got a token for the wrong issuer! (%s)' % id_info['iss'])
     return id_info
@@ -50,21 +82,142 @@ def show_login():
 
 @app.route('/orders')
 def show_my_orders():
-    """Show the currently logged-in user's orders."""
+    """Show the currently logged-in user's orders, across all locations.
+
+    The response's `next` is a token for the following request to pass as
+    ?since=, to get only the orders created or changed in the meantime.
+    """
     user = read_jwt_token(flask.request)
-    app.logger.info('Reading orders for %s', user['sub'])
-    orders = model.UserOrders(db, user['sub'])
-    data = [{'id': user['sub']}]
-    data.extend(orders)
+    since = flask.request.args.get('since')
+    if since:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            flask.abort(400, 'Bad since token')
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+    next_since = datetime.datetime.now(datetime.timezone.utc) - SYNC_OVERLAP
+    app.logger.info('Reading orders for %s since %s', user['sub'], since)
+    orders = []
+    with limiter.admit(user['sub'], '/orders'):
+        for location in model.Locations(db):
+            orders.extend(model.UserOrders(db, user['sub'], location, since))
+    data = {'id': user['sub'], 'orders': orders,
+            'next': next_since.isoformat()}
     return simplejson.dumps(data, for_json=True, indent=2)
 
+
+def request_location():
+    """Returns the request's ?location=, aborting with a 400 unless it's
+    the id of a known location."""
+    location = flask.request.args.get('location', model.DEFAULT_LOCATION)
+    if '/' in location or location not in known_locations.do(
+            'all', model.Locations, db):
+        flask.abort(400, 'Unknown location')
+    return location
+
+
+def render_chef(location):
+    orders = sorted(model.OpenOrders(db, location),
+                    key=lambda x: x.date.ToDatetime().timestamp())
+    app.logger.info('Orders are: %s', orders)
+    return flask.render_template('chef.html', orders=orders,
+                                 location=location)
+
+
 @app.route('/chef')
 def show_todo_orders():
-    """Show any orders not yet marked done."""
-    orders = [x for x in model.OpenOrders(db)]
-    orders.sort(key=lambda x: x.date.ToDatetime().timestamp())
-    app.logger.info('Orders are: %s', orders)
-    return flask.render_template('chef.html', orders=orders)
+    """Show any orders not yet marked done at the ?location= kitchen."""
+    location = request_location()
+    # The kitchen view doesn't sign in, so limit by client address.
+    with limiter.admit(client_address(flask.request), '/chef'):
+        return chef_pages.do(location, render_chef, location)
+
+
+@app.route('/stats')
+def show_stats():
+    """Show sales for a ?location= over a ?period= (UTC day or hour).
+
+    Periods look like 2019-04-09 or 2019-04-09T13, and default to today.
+    """
+    location = request_location()
+    period = flask.request.args.get(
+        'period', datetime.datetime.utcnow().strftime('%Y-%m-%d'))
+    with limiter.admit(client_address(flask.request), '/stats'):
+        stats = model.Rollup(db, location, period)
+    stats.update(location=location, period=period)
+    return flask.jsonify(stats)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Export this instance's metrics in the Prometheus text format."""
+    return flask.Response(metrics.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_timer():
+    flask.g.start_time = time.perf_counter()
+    flask.g.span = tracing.start_span(flask.request.path)
+    flask.g.profiler = None
+    if profiling.should_profile(
+            flask.request.headers.get(profiling.PROFILE_HEADER)):
+        flask.g.profiler = profiling.start()
+
+
+def request_route():
+    route = flask.request.url_rule
+    return route.rule if route else 'unmatched'
+
+
+@app.after_request
+def record_status(resp):
+    flask.g.status = resp.status_code
+    flask.g.span.attributes['status'] = resp.status_code
+    return resp
+
+
+@app.teardown_request
+def record_metrics(exc):
+    """Counts and times the request.
+
+    Teardown runs even when a view raises, unlike after_request, so failed
+    requests are counted too.
+    """
+    if 'start_time' not in flask.g:
+        return
+    elapsed = time.perf_counter() - flask.g.start_time
+    failed = exc is not None or flask.g.get('status', 500) >= 500
+    metrics.record_request(elapsed, failed=failed, route=request_route())
+
+
+@app.teardown_request
+def finish_trace(exc):
+    """Finishes the request's span, even if the view raised, so that it
+    isn't left as the parent of later requests on this thread."""
+    span = flask.g.get('span')
+    if span:
+        flask.g.span = None
+        if exc is not None:
+            span.attributes['error'] = repr(exc)
+        tracing.finish_span(span)
+
+
+@app.teardown_request
+def finish_profile(exc):
+    """Stops the request's profiler, if any, even if the view raised."""
+    profiler = flask.g.get('profiler')
+    if profiler:
+        flask.g.profiler = None
+        profiling.finish(profiler, request_route(),
+                         time.perf_counter() - flask.g.start_time)
+
+
+@app.errorhandler(ratelimit.Throttled)
+def throttled(e):
+    return flask.Response('Too many requests, try again shortly.\n', 429,
+                          {'Retry-After': str(int(e.retry_after + 1))})
 
 
 @app.route('/static/<path:path>')
@@ -72,9 +225,39 @@ def serve_static(path):
     return flask.send_from_directory('static', path, cache_timeout=60)
 
 
+@app.route('/_ah/warmup')
+def warmup():
+    """Prime this instance before App Engine sends it any traffic.
+
+    Each step is timed separately so slow cold starts can be attributed.
+    """
+    # A cheap listing opens the Firestore channel, so that the settings step
+    # times only their read, which is made even if they're already loaded.
+    steps = [
+        ('firestore', lambda: model.Locations(db)),
+        ('settings', load_settings),
+        ('menu', lambda: model.CachedMenu(db)),
+        ('certs', auth.fetch_certs),
+    ]
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    app.logger.info('Warmup timings (ms): %s', timings)
+    return flask.jsonify(timings)
+
+
 @app.before_first_request
 def initialize():
+    if settings:
+        return
     app.logger.setLevel(logging.INFO)
+    load_settings()
+
+
+def load_settings():
+    """Reads the app's settings, even if they've been read before."""
     client_id = os.getenv('CLIENT_ID', '')
     if not client_id:
         config = db.document('config/app').get()
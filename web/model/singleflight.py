@@ -0,0 +1,77 @@
+"""Coalescing of concurrent identical calls.
+
+When many threads ask a Group for the same key at once, only the first runs
+the call; the others wait for it and share its result, or its exception. With
+a `ttl`, the result is also reused by calls for the key in the following ttl
+seconds. Firestore load then depends on how often a result is needed, not on
+how many requests need it. Expired results are dropped as calls are made, so
+only the keys used in about the last 2 * ttl seconds are kept.
+
+Shared results are handed to every caller, so they must not be modified.
+"""
+
+import threading
+import time
+
+from model import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None
+
+
+class Group:
+    def __init__(self, name, ttl=0):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._next_sweep = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Returns fn(*args, **kwargs), sharing any call in flight for key."""
+        with self._lock:
+            now = time.monotonic()
+            if self.ttl and now >= self._next_sweep:
+                self._sweep(now)
+            call = self._calls.get(key)
+            if call and call.expires is not None and now >= call.expires:
+                call = None
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            cached = call.done.is_set()
+            metrics.inc('singleflight_calls_total', group=self.name,
+                        result='cached' if cached else 'shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.inc('singleflight_calls_total', group=self.name,
+                    result='leader')
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if call.error is None and self.ttl:
+                    call.expires = time.monotonic() + self.ttl
+                elif self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _sweep(self, now):
+        """Drops expired results; called with the lock held."""
+        for key, call in list(self._calls.items()):
+            if call.expires is not None and now >= call.expires:
+                del self._calls[key]
+        self._next_sweep = now + self.ttl
@@ -21,32 +21,42 @@ function domTree(type, properties, ...children) {
   return domNode;
 }
 
+// Order id -> the DOM node currently showing that order.
+let orderNodes = new Map();
+
 /**
- * Render order data into the "order" element in the document.
- * @param {*} data
+ * Render orders into the "orders" element in the document, replacing the
+ * nodes of any orders already shown, and adding the rest at the end.
+ * @param {*} orders
  */
-function renderOrder(data) {
+function renderOrder(orders) {
   let container = document.getElementById("orders");
-  for (let e of Array.from(container.childNodes)) {
-    e.remove();
-  }
-  for (let item of data) {
-    if (item["items"] == undefined) {
-      continue;
+  orders.sort((a, b) => new Date(a.date) - new Date(b.date));
+  for (let item of orders) {
+    let order = makeOrder(item);
+    let existing = orderNodes.get(item.id);
+    if (existing) {
+      existing.replaceWith(order);
+    } else {
+      container.appendChild(order);
     }
-    entree_box = domTree("div", { className: "mdc-layout-grid__inner"})
-    order = domTree("div", {className: "mdc-layout-grid__cell--span-12" },
-        domTree("div", { className: "mdc-card order" },
-          domTree("h3", { className: "order-item mdc-typography mdc-typography--headline5" },
-            new Date(item.date).toLocaleString("en-US")),
-          entree_box,
-          domTree('div', {className: "mdc-typography total"},
-            'Total: ' + item.totalPrice.toFixed(2))))
-    for (let entree of item["items"]) {
-      entree_box.appendChild(makeEntree(entree))
-    }
-    container.appendChild(order)
+    orderNodes.set(item.id, order);
+  }
+}
+
+function makeOrder(item) {
+  entree_box = domTree("div", { className: "mdc-layout-grid__inner"})
+  order = domTree("div", {className: "mdc-layout-grid__cell--span-12" },
+      domTree("div", { className: "mdc-card order" },
+        domTree("h3", { className: "order-item mdc-typography mdc-typography--headline5" },
+          new Date(item.date).toLocaleString("en-US")),
+        entree_box,
+        domTree('div', {className: "mdc-typography total"},
+          'Total: ' + (item.totalPrice || 0).toFixed(2))))
+  for (let entree of item["items"]) {
+    entree_box.appendChild(makeEntree(entree))
   }
+  return order
 }
 
 function makeEntree(entree) {
@@ -77,17 +87,40 @@ function makeEntree(entree) {
   );
 }
 
-function fetchOrders(googleUser) {
+// How often to check for new or changed orders.
+const POLL_INTERVAL_MS = 15000;
+
+/**
+ * Shows the user's orders, then polls for changes to them. After the first
+ * fetch, only orders changed since the previous one are downloaded.
+ * @param {*} googleUser
+ * @param {string} since The token from the previous fetch, if any.
+ */
+function fetchOrders(googleUser, since) {
   // The ID token you need to pass to your backend:
   var id_token = googleUser.getAuthResponse().id_token;
-  // TODO: redirect to order view page
-  fetch("/orders", { headers: { Authorization: "Bearer " + id_token } })
+  let url = "/orders";
+  if (since) {
+    url += "?since=" + encodeURIComponent(since);
+  }
+  fetch(url, { headers: { Authorization: "Bearer " + id_token } })
     .then(resp => {
       console.log("Got " + resp.status);
+      if (resp.status == 429) {
+        // Throttled; keep showing what we have until the next fetch.
+        return null;
+      }
       return resp.json();
     })
     .then(data => {
-      console.log(data);
-      renderOrder(data);
+      if (data != null) {
+        console.log(data);
+        renderOrder(data.orders);
+        since = data.next;
+      }
+    })
+    .catch(error => console.log(error))
+    .finally(() => {
+      setTimeout(() => fetchOrders(googleUser, since), POLL_INTERVAL_MS);
     });
 }